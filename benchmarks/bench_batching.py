@@ -0,0 +1,82 @@
+"""Compares sending concurrent prompts one request each with sending them
+through a CompletionBatcher, against the mock API in mock_server.py.
+
+Every prompt is sent at a random time within a short burst, and the mock
+API takes a fixed time to answer every request. Run from the repository
+root (a config.json is needed):
+
+    python -m benchmarks.bench_batching [prompts] [burst seconds]
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+
+import mock_server
+import shirt_bot_utils
+from shirt_bot_utils import CompletionBatcher, bot, create_api_session
+
+LATENCY = 0.05
+PARAMS = {"max_tokens": 20, "temperature": 0.9, "n": 1, "stop": ["\n"]}
+
+
+async def send_single(url, prompt):
+    return await shirt_bot_utils.post_completion(
+        url,
+        json.dumps({**PARAMS, "prompt": prompt})
+    )
+
+
+async def run(name, send, count, burst):
+    mock = mock_server.MockAPI(latency=LATENCY)
+    runner, url = await mock_server.start(mock)
+    url += "/completions"
+    rng = random.Random(0)
+    latencies = []
+
+    async def one(i):
+        await asyncio.sleep(rng.uniform(0, burst))
+        start = time.perf_counter()
+        response = await send(url, f"prompt {i}")
+        assert len(response["choices"]) == 1
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+    latencies.sort()
+    print(
+        f"{name:<16}  {mock.requests:>8}  {elapsed:>6.2f}s"
+        f"  {latencies[len(latencies) // 2] * 1000:>6.1f}ms"
+        f"  {latencies[int(len(latencies) * 0.99)] * 1000:>6.1f}ms"
+    )
+
+
+async def main(count, burst):
+    bot.api_session = create_api_session()
+    print(
+        f"{count} prompts within {burst}s, "
+        f"{LATENCY * 1000:.0f}ms API latency"
+    )
+    print(
+        f"{'mode':<16}  {'requests':>8}  {'total':>7}"
+        f"  {'p50':>8}  {'p99':>8}"
+    )
+    await run("one per request", send_single, count, burst)
+    for window in (0.002, 0.005, 0.02):
+        batcher = CompletionBatcher(window=window)
+
+        async def send_batched(url, prompt):
+            return await batcher.submit(url, {**PARAMS, "prompt": prompt})
+
+        await run(f"batched {window * 1000:.0f}ms", send_batched, count, burst)
+    await bot.api_session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    ))
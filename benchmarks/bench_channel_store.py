@@ -0,0 +1,164 @@
+"""Compares the old text files with the SQLite channel store at a large
+number of configured channels: loading everything at startup, the memory
+the settings take once loaded, and the cost of a single settings change,
+written on its own or in a batch like SettingsWriter writes them.
+
+The text file update copies the file to a backup and rewrites it whole,
+like update_data_files used to. After migrating, the channels are put in
+guilds of GUILD_SIZE, like assign_guilds does once the bot can see them,
+so the registry's memory includes its guild index. Runs in a temporary
+directory, from the repository root:
+
+    python -m benchmarks.bench_channel_store [channels] [updates]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from channel_store import ChannelSettings, ChannelStore
+
+# Channels per guild.
+GUILD_SIZE = 50
+
+
+def write_text_files(directory, channels, rng):
+    settings = {name: {} for name in (
+        "shirt_talk", "shirt_reply", "shirt_random", "uncensored_links"
+    )}
+    for channel_id in range(10**17, 10**17 + channels):
+        name = rng.choice(list(settings))
+        if name == "shirt_random":
+            settings[name][channel_id] = (45.0, 10.0)
+        else:
+            settings[name][channel_id] = 45.0
+    for name, values in settings.items():
+        with open(os.path.join(directory, f"{name}.txt"), "w") as file:
+            if name == "uncensored_links":
+                file.write("\n".join(map(str, values)))
+            elif name == "shirt_random":
+                file.write("\n".join(
+                    f"{k} {' '.join(map(str, v))}" for k, v in values.items()
+                ))
+            else:
+                file.write("\n".join(f"{k} {v}" for k, v in values.items()))
+    return settings
+
+
+def load_text_files(directory):
+    def read(name):
+        with open(os.path.join(directory, f"{name}.txt")) as file:
+            return file.read().split("\n")
+
+    talk = {
+        int(k.split()[0]): float(k.split()[1])
+        for k in read("shirt_talk") if k
+    }
+    reply = {
+        int(k.split()[0]): float(k.split()[1])
+        for k in read("shirt_reply") if k
+    }
+    random_ = {
+        int(k.split()[0]): tuple(float(x) for x in k.split()[1:])
+        for k in read("shirt_random") if k
+    }
+    uncensored = [int(k) for k in read("uncensored_links") if k]
+    return talk, reply, random_, uncensored
+
+
+def update_text_file(directory, talk, channel_id):
+    talk[channel_id] = 30.0
+    path = os.path.join(directory, "shirt_talk.txt")
+    with open(os.path.join(directory, "shirt_talk_backup.txt"), "w") as bak, \
+            open(path, "r+") as file:
+        bak.write(file.read())
+        file.seek(0)
+        file.write("\n".join(f"{k} {v}" for k, v in talk.items()))
+        file.truncate()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def allocated(function, *args):
+    tracemalloc.start()
+    result = function(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def main(channels, updates):
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        write_text_files(directory, channels, rng)
+        database = os.path.join(directory, "shirt_bot.db")
+
+        text_load, (talk, *_) = timed(load_text_files, directory)
+        migrate, store = timed(ChannelStore, database, directory)
+        with store.transaction():
+            store.set_guilds(
+                (channel_id, channel_id // GUILD_SIZE)
+                for channel_id in range(10**17, 10**17 + channels)
+            )
+        store.close()
+        store_load, _ = timed(
+            lambda: ChannelSettings.load(ChannelStore(database).load())
+        )
+        text_memory, _ = allocated(load_text_files, directory)
+        store_memory, _ = allocated(
+            lambda: ChannelSettings.load(ChannelStore(database).load())
+        )
+
+        ids = [
+            rng.randrange(10**17, 10**17 + channels) for _ in range(updates)
+        ]
+        # The old way is slow enough that a few updates are plenty.
+        text_updates = ids[:max(updates // 20, 1)]
+        text_update, _ = timed(lambda: [
+            update_text_file(directory, talk, channel_id)
+            for channel_id in text_updates
+        ])
+        store = ChannelStore(database)
+        store_update, _ = timed(lambda: [
+            store.apply("SET_SHIRT_TALK", channel_id, 30.0)
+            for channel_id in ids
+        ])
+
+        def batched():
+            with store.transaction():
+                for channel_id in ids:
+                    store.apply("SET_SHIRT_TALK", channel_id, 45.0)
+
+        store_batch, _ = timed(batched)
+        store.close()
+
+    print(f"{channels} channels")
+    print(f"{'':<12}  {'startup':>9}  {'memory':>8}  {'per update':>10}")
+    print(
+        f"{'text files':<12}  {text_load * 1000:>7.1f}ms"
+        f"  {text_memory / 2**20:>6.1f}MB"
+        f"  {text_update / len(text_updates) * 1000:>8.3f}ms"
+    )
+    print(
+        f"{'sqlite':<12}  {store_load * 1000:>7.1f}ms"
+        f"  {store_memory / 2**20:>6.1f}MB"
+        f"  {store_update / len(ids) * 1000:>8.3f}ms"
+    )
+    print(
+        f"{'sqlite batch':<12}  {'':>9}  {'':>8}"
+        f"  {store_batch / len(ids) * 1000:>8.3f}ms"
+    )
+    print(f"one-time migration: {migrate * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    )
@@ -0,0 +1,78 @@
+"""Compares CommandClassifier against Bot.get_context for finding out which
+command a message invokes.
+
+Run from the repository root (a config.json is needed):
+
+    python -m benchmarks.bench_classifier [number of messages]
+"""
+import asyncio
+import random
+import sys
+import time
+
+import discord
+
+import shirt_bot  # Registers the commands.
+from shirt_bot_utils import CommandClassifier, PREFIX, bot
+
+
+class FakeMessage:
+    """Just enough of a discord.Message for Bot.get_context."""
+
+    def __init__(self, content, author):
+        self.content = content
+        self.author = author
+        self._state = bot._connection
+
+
+def make_messages(count, seed=0):
+    rng = random.Random(seed)
+    prefixes = PREFIX.split(' ')
+    names = list(bot.all_commands)
+    words = ["hello", "what", "is", "the", "shirt", "doing", "lol", "ok"]
+    users = [discord.Object(id=i) for i in range(1, 20)]
+    messages = []
+    for _ in range(count):
+        roll = rng.random()
+        text = ' '.join(rng.choices(words, k=rng.randint(1, 12)))
+        if roll < 0.1:
+            content = f"{rng.choice(prefixes)}{rng.choice(names)} {text}"
+        elif roll < 0.12:
+            content = f"{rng.choice(prefixes)}reset"
+        elif roll < 0.15:
+            content = f"{rng.choice(prefixes)}{text}"
+        else:
+            content = text
+        messages.append(FakeMessage(content, rng.choice(users)))
+    return messages
+
+
+async def main(count):
+    # get_context needs to know who the bot is.
+    bot._connection.user = discord.Object(id=0)
+    classifier = CommandClassifier(bot.command_prefix, bot.all_commands)
+    messages = make_messages(count)
+
+    start = time.perf_counter()
+    expected = []
+    for message in messages:
+        context = await bot.get_context(message)
+        expected.append(context.command.name if context.valid else None)
+    context_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    got = [classifier.classify(message.content) for message in messages]
+    classifier_time = time.perf_counter() - start
+
+    if got != expected:
+        sys.exit("The classifier and get_context disagree.")
+
+    print(f"messages:       {count}")
+    print(f"commands:       {sum(x is not None for x in expected)}")
+    print(f"get_context:    {context_time * 1000:.1f} ms")
+    print(f"classifier:     {classifier_time * 1000:.1f} ms")
+    print(f"speedup:        {context_time / classifier_time:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
@@ -0,0 +1,353 @@
+"""Drives the bot's message handlers with synthetic Discord traffic and the
+mock completion backend, and prints the results as JSON.
+
+Messages are sent at random times into fake channels, each of them a
+shirt talk, shirt reply or shirt random channel or a plain channel for the
+trigger command. Every message goes through the same listener or command
+the real bot would use, with fake messages, channels and history in place
+of Discord. Reported are the handler latencies per mode, API calls per
+message, the event loop's lag, the process's peak memory and where the
+slowest replies spent their time.
+
+Run from the repository root (a config.json is needed):
+
+    python -m benchmarks.bench_e2e --channels 20 --rate 50 --duration 10
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import resource
+import time
+
+import discord
+from discord.ext.commands.view import StringView
+
+import shirt_bot
+import shirt_bot_utils
+from shirt_bot_utils import (
+    ENCODER, CommandClassifier, LoopLagMonitor, MockBackend, ShirtContext,
+    bot, create_api_session, record_message, tokenizer
+)
+
+KINDS = ("talk", "reply", "random", "trigger")
+WORDS = (
+    "shirt bot hello what are you doing today i think that is a good idea "
+    "no way did you see the game last night lol why would anyone do that"
+).split()
+
+message_ids = itertools.count(1 << 40)
+
+
+class FakeUser:
+    def __init__(self, name, is_bot=False):
+        self.id = next(message_ids)
+        self.name = name
+        self.bot = is_bot
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, me):
+        self.id = next(message_ids)
+        self.me = me
+
+
+class FakeTyping:
+    def __await__(self):
+        return asyncio.sleep(0).__await__()
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeReference:
+    def __init__(self, resolved):
+        self.resolved = resolved
+
+
+class FakeMessage:
+    _state = None
+
+    def __init__(self, channel, author, content, *, reference=None,
+                 type=discord.MessageType.default):
+        self.id = next(message_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.reference = FakeReference(reference) if reference else None
+        self.type = type
+
+    async def delete(self):
+        self.channel.messages.remove(self)
+
+
+class FakeChannel:
+    """A text channel whose history is a list and whose sent messages go
+    back through record_message, like the gateway would send them."""
+
+    def __init__(self, guild, bot_user):
+        self.id = next(message_ids)
+        self.guild = guild
+        self.bot_user = bot_user
+        self.messages = []
+        self.sent = 0
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    def typing(self):
+        return FakeTyping()
+
+    async def history(self, limit=100, before=None):
+        for message in reversed(self.messages):
+            if limit is not None and limit <= 0:
+                return
+            if before is not None and message.id >= before.id:
+                continue
+            yield message
+            if limit is not None:
+                limit -= 1
+
+    def add(self, message):
+        self.messages.append(message)
+        record_message(message)
+        return message
+
+    async def send(self, content=None, *, reference=None, **kwargs):
+        self.sent += 1
+        return self.add(FakeMessage(
+            self,
+            self.bot_user,
+            content or "",
+            reference=reference,
+            type=(
+                discord.MessageType.reply if reference is not None
+                else discord.MessageType.default
+            )
+        ))
+
+
+async def get_context(message, cls=None):
+    return ShirtContext(
+        message=message,
+        bot=bot,
+        view=StringView(message.content)
+    )
+
+
+async def context_send(self, content=None, **kwargs):
+    return await self.channel.send(content, **kwargs)
+
+
+async def wait_until_ready():
+    pass
+
+
+def random_text(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(2, 15)))
+
+
+def make_channels(count, users, bot_user, rng):
+    guild = FakeGuild(bot_user)
+    channels = collections.defaultdict(list)
+    for i in range(count):
+        kind = KINDS[i % len(KINDS)]
+        channel = FakeChannel(guild, bot_user)
+        settings = shirt_bot_utils.channel_settings
+        if kind == "talk":
+            settings.apply("SET_SHIRT_TALK", channel.id, 45, None, guild.id)
+        elif kind == "reply":
+            settings.apply("SET_SHIRT_REPLY", channel.id, 45, None, guild.id)
+        elif kind == "random":
+            settings.apply("SET_SHIRT_RANDOM", channel.id, 45, 100, guild.id)
+        # Replies show up in prompts, as the message collector skips
+        # messages of the default type.
+        for _ in range(30):
+            channel.messages.append(FakeMessage(
+                channel,
+                rng.choice(users),
+                random_text(rng),
+                type=discord.MessageType.reply
+            ))
+        channels[kind].append(channel)
+    return channels
+
+
+async def send_message(kind, channel, users, rng, latencies):
+    author = rng.choice(users)
+    if kind == "trigger":
+        message = channel.add(FakeMessage(
+            channel,
+            author,
+            f"{bot.command_prefix[0]}trigger"
+        ))
+        ctx = await get_context(message)
+        ctx.invoked_with = "trigger"
+        start = time.perf_counter()
+        await shirt_bot.bot_trigger.callback(
+            ctx,
+            80,
+            45,
+            text=""
+        )
+    else:
+        reference = None
+        if kind == "reply":
+            bot_messages = [
+                m for m in channel.messages[-20:]
+                if m.author is channel.bot_user
+            ]
+            reference = bot_messages[-1] if bot_messages else FakeMessage(
+                channel, channel.bot_user, random_text(rng)
+            )
+        message = FakeMessage(
+            channel,
+            author,
+            random_text(rng),
+            reference=reference
+        )
+        channel.messages.append(message)
+        start = time.perf_counter()
+        await shirt_bot.dispatch_on_message(message)
+    latencies[kind].append(time.perf_counter() - start)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+
+    def at(p):
+        return round(samples[min(int(len(samples) * p), len(samples) - 1)]
+                     * 1000, 2)
+
+    return {
+        "count": len(samples),
+        "p50_ms": at(0.5),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(samples[-1] * 1000, 2),
+    }
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    mix = dict(zip(KINDS, args.mix))
+
+    bot_user = FakeUser(shirt_bot_utils.NAME, is_bot=True)
+    bot._connection.user = bot_user
+    bot.get_context = get_context
+    bot.wait_until_ready = wait_until_ready
+    ShirtContext.send = context_send
+    bot.command_classifier = CommandClassifier(
+        bot.command_prefix,
+        bot.all_commands
+    )
+    bot.api_session = create_api_session()
+    shirt_bot_utils.backend = MockBackend(
+        latency=args.api_latency,
+        error_rate=args.error_rate
+    )
+    await shirt_bot_utils.backend.start()
+    ENCODER.load()
+    tokenizer.start()
+    monitor = LoopLagMonitor(interval=0.01)
+    monitor_task = asyncio.create_task(monitor.run())
+
+    users = [FakeUser(f"user{i}") for i in range(50)]
+    channels = make_channels(args.channels, users, bot_user, rng)
+    kinds = [kind for kind in KINDS if channels[kind] and mix[kind] > 0]
+    weights = [mix[kind] for kind in kinds]
+
+    latencies = collections.defaultdict(list)
+    tasks = []
+    messages = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.duration:
+        kind = rng.choices(kinds, weights)[0]
+        tasks.append(asyncio.create_task(send_message(
+            kind,
+            rng.choice(channels[kind]),
+            users,
+            rng,
+            latencies
+        )))
+        messages += 1
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    monitor_task.cancel()
+    await shirt_bot_utils.backend.close()
+    await bot.api_session.close()
+    tokenizer.close()
+
+    api_calls = shirt_bot_utils.backend.mock.requests
+    replies = sum(
+        channel.sent for kind in channels.values() for channel in kind
+    )
+    return {
+        "config": {
+            "channels": args.channels,
+            "rate": args.rate,
+            "duration": args.duration,
+            "mix": mix,
+            "api_latency": args.api_latency,
+            "error_rate": args.error_rate,
+            "seed": args.seed,
+        },
+        "messages": messages,
+        "replies": replies,
+        "elapsed_s": round(elapsed, 3),
+        "api_calls": api_calls,
+        "api_calls_per_message": round(api_calls / messages, 4),
+        "latency": {
+            "all": percentiles(
+                [x for samples in latencies.values() for x in samples]
+            ),
+            **{kind: percentiles(latencies[kind]) for kind in kinds},
+        },
+        "loop_lag": monitor.stats(),
+        "slowest_traces": shirt_bot_utils.tracer.breakdown(),
+        # Kilobytes on Linux.
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=50,
+                        help="messages per second, over all channels")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to send messages for")
+    parser.add_argument(
+        "--mix", type=lambda s: [float(x) for x in s.split(",")],
+        default=[0.4, 0.2, 0.2, 0.2],
+        help="weights of talk, reply, random and trigger messages"
+    )
+    parser.add_argument("--api-latency", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results here")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(main(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
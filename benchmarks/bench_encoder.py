@@ -0,0 +1,72 @@
+"""Measures the encoder's encode and decode throughput and peak memory on
+the corpora in encoder_corpora.py, with cold and warm word caches.
+
+Cold runs start with an empty cache, warm runs encode the same corpus a
+second time. Peak memory is measured with tracemalloc in a separate cold
+run, as tracing slows everything down. Run from the repository root:
+
+    python -m benchmarks.bench_encoder [repeats]
+"""
+import sys
+import time
+import tracemalloc
+
+from benchmarks.encoder_corpora import CORPORA
+from encoder import encoder
+
+
+def best_time(function, repeats, setup=None):
+    best = float("inf")
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def encode_all(enc, texts):
+    return [enc.encode(text) for text in texts]
+
+
+def peak_memory(enc, texts):
+    enc.cache.clear()
+    tracemalloc.start()
+    encode_all(enc, texts)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(repeats):
+    enc = encoder.get_encoder()
+    print(
+        f"{'corpus':<12}  {'tokens':>8}  {'cold tok/s':>11}  "
+        f"{'warm tok/s':>11}  {'cold MB/s':>9}  {'decode tok/s':>12}  "
+        f"{'peak MB':>7}"
+    )
+    for name, make in CORPORA.items():
+        texts = make()
+        size = sum(len(text.encode("utf-8")) for text in texts)
+        ids = encode_all(enc, texts)
+        tokens = sum(map(len, ids))
+
+        cold = best_time(
+            lambda: encode_all(enc, texts),
+            repeats,
+            setup=enc.cache.clear
+        )
+        warm = best_time(lambda: encode_all(enc, texts), repeats)
+        decode = best_time(lambda: [enc.decode(x) for x in ids], repeats)
+        peak = peak_memory(enc, texts)
+
+        print(
+            f"{name:<12}  {tokens:>8}  {tokens / cold:>11,.0f}  "
+            f"{tokens / warm:>11,.0f}  {size / cold / 1e6:>9.2f}  "
+            f"{tokens / decode:>12,.0f}  {peak / 1e6:>7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,62 @@
+"""Measures how long loading the encoder takes and how much memory it uses,
+and how long importing shirt_bot_utils takes now that the encoder is
+loaded lazily.
+
+Every measurement runs in a fresh interpreter. Run from the repository root
+(a config.json is needed for the import measurement):
+
+    python -m benchmarks.bench_encoder_load [runs]
+"""
+import json
+import subprocess
+import sys
+
+CHILD = """
+import json, resource, time
+start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+end_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([elapsed, start_rss, end_rss]))
+"""
+
+CASES = {
+    "load encoder": (
+        "from encoder import encoder\n"
+        "encoder.get_encoder()"
+    ),
+    "import shirt_bot_utils": "import shirt_bot_utils",
+    "import shirt_bot_utils and load": (
+        "import shirt_bot_utils\n"
+        "shirt_bot_utils.ENCODER.load()"
+    ),
+}
+
+
+def measure(code):
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(code=code)],
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(runs):
+    print(
+        f"{'case':<32}  {'best time':>9}  {'rss before':>10}"
+        f"  {'rss after':>9}"
+    )
+    for name, code in CASES.items():
+        results = [measure(code) for _ in range(runs)]
+        elapsed, start_rss, end_rss = min(results)
+        print(
+            f"{name:<32}  {elapsed * 1000:>7.1f}ms"
+            f"  {start_rss / 1024:>8.1f}MB  {end_rss / 1024:>7.1f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
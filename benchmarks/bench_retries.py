@@ -0,0 +1,56 @@
+"""Runs post_completion against the mock API through scripted failures and
+reports how many requests it took, how long it waited and how it ended.
+
+Run from the repository root (a config.json is needed):
+
+    python -m benchmarks.bench_retries
+"""
+import asyncio
+import time
+
+import mock_server
+import shirt_bot_utils
+from shirt_bot_utils import CompletionError, bot, create_api_session
+
+SCENARIOS = [
+    ("rate limited, Retry-After 1s", [429, 429], {"retry_after": 1}),
+    ("rate limited, no Retry-After", [429] * 4, {}),
+    ("server errors", [500, 502, 503], {}),
+    ("bad request", [400], {}),
+    ("outage", [503], {"repeat": True}),
+]
+
+
+async def run(name, script, options):
+    shirt_bot_utils.circuit_breaker.success()
+    mock = mock_server.MockAPI(script, **options)
+    runner, url = await mock_server.start(mock)
+    start = time.perf_counter()
+    try:
+        await shirt_bot_utils.post_completion(
+            url + "/completions", "{}", deadline=10
+        )
+        outcome = "ok"
+    except CompletionError as e:
+        outcome = type(e).__name__
+    elapsed = time.perf_counter() - start
+    await runner.cleanup()
+    print(
+        f"{name:<30}  {mock.requests:>8}  {elapsed:>6.2f}s  {outcome:<12}"
+        f"  {shirt_bot_utils.circuit_breaker.state}"
+    )
+
+
+async def main():
+    bot.api_session = create_api_session()
+    print(
+        f"{'scenario':<30}  {'requests':>8}  {'time':>7}  {'outcome':<12}"
+        "  circuit"
+    )
+    for scenario in SCENARIOS:
+        await run(*scenario)
+    await bot.api_session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""Measures the event loop's lag while long prompts are tokenized with
+every tokenizer executor mode.
+
+Each mode starts with cold encoder caches and counts the tokens of a batch
+of long, random prompts while a LoopLagMonitor samples the loop. Run from
+the repository root (a config.json is needed):
+
+    python -m benchmarks.bench_tokenizer_offload [prompts] [prompt chars]
+"""
+import asyncio
+import random
+import sys
+import time
+
+from shirt_bot_utils import ENCODER, LoopLagMonitor, Tokenizer
+
+
+def make_prompts(count, length, seed=0):
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyzäöüßéñ😀日本語"
+    prompts = []
+    for _ in range(count):
+        words = []
+        while sum(map(len, words)) < length:
+            words.append("".join(rng.choices(alphabet, k=rng.randint(1, 12))))
+        prompts.append(" ".join(words)[:length])
+    return prompts
+
+
+async def measure(mode, prompts):
+    ENCODER.cache.clear()
+    tokenizer = Tokenizer(mode)
+    tokenizer.start()
+    # Lets the worker processes load their encoders before measuring.
+    await asyncio.sleep(1)
+
+    monitor = LoopLagMonitor(interval=0.005)
+    monitor_task = asyncio.create_task(monitor.run())
+    await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    for prompt in prompts:
+        await tokenizer.run("count_tokens", prompt, size=len(prompt))
+        # Gives the monitor a chance to run, like other events would.
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    await asyncio.sleep(0.05)
+    monitor_task.cancel()
+    tokenizer.close()
+    lags = sorted(monitor.samples)
+    return elapsed, lags[int(len(lags) * 0.99)], lags[-1]
+
+
+async def main(count, length):
+    ENCODER.load()
+    prompts = make_prompts(count, length)
+    print(f"{count} prompts of {length} characters, cold caches")
+    print(f"{'executor':<8}  {'total':>8}  {'p99 lag':>8}  {'max lag':>8}")
+    for mode in ("inline", "thread", "process"):
+        elapsed, p99, worst = await measure(mode, prompts)
+        print(
+            f"{mode:<8}  {elapsed * 1000:>6.0f}ms"
+            f"  {p99 * 1000:>6.1f}ms  {worst * 1000:>6.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    ))
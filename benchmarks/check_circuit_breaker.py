@@ -0,0 +1,105 @@
+"""Checks that the circuit breaker lets requests through again after its
+trial request ends without a success or a failure: cancelled, rate
+limited or stopped by an error from on_text.
+
+Each case opens the circuit against the mock API, waits for it to go
+half-open, ends the trial that way and then expects the next request to
+be sent. Run from the repository root (a config.json is needed):
+
+    python -m benchmarks.check_circuit_breaker
+"""
+import asyncio
+import json
+import sys
+
+import mock_server
+import shirt_bot_utils
+from shirt_bot_utils import (
+    CircuitBreaker, CircuitOpen, CompletionError, bot, create_api_session
+)
+
+RESET = 0.2
+STREAM = json.dumps({"prompt": "", "stream": True})
+
+
+class SendFailed(Exception):
+    pass
+
+
+async def cancelled(url):
+    task = asyncio.create_task(shirt_bot_utils.post_completion(url, "{}"))
+    await asyncio.sleep(0.1)
+    task.cancel()
+    result, = await asyncio.gather(task, return_exceptions=True)
+    return isinstance(result, asyncio.CancelledError)
+
+
+async def rate_limited(url):
+    try:
+        await shirt_bot_utils.post_completion(url, "{}", deadline=0)
+    except CompletionError as e:
+        return getattr(e, "status", None) == 429
+    return False
+
+
+async def on_text_failed(url):
+    async def on_text(text):
+        raise SendFailed()
+
+    try:
+        await shirt_bot_utils.post_completion(url, STREAM, on_text=on_text)
+    except SendFailed:
+        return True
+    return False
+
+
+CASES = [
+    # The trial's responses come after the one that opens the circuit.
+    ("cancelled", cancelled, [500, 200, 200], {"latency": 0.5}),
+    ("rate limited", rate_limited, [500, 429, 200], {}),
+    ("on_text raised", on_text_failed, [500, 200, 200], {}),
+]
+
+
+async def check(name, end_trial, script, options):
+    shirt_bot_utils.circuit_breaker = CircuitBreaker(
+        failure_threshold=1,
+        reset_timeout=RESET
+    )
+    mock = mock_server.MockAPI(script, **options)
+    runner, url = await mock_server.start(mock)
+    url += "/completions"
+    try:
+        opened = False
+        try:
+            await shirt_bot_utils.post_completion(url, "{}", deadline=0)
+        except CompletionError:
+            opened = True
+        await asyncio.sleep(RESET)
+        ended = await end_trial(url)
+        mock.latency = 0.0
+        try:
+            await shirt_bot_utils.post_completion(url, "{}", deadline=0)
+            outcome = "ok"
+        except CircuitOpen:
+            outcome = "circuit stuck open"
+        except CompletionError as e:
+            outcome = type(e).__name__
+    finally:
+        await runner.cleanup()
+    passed = opened and ended and outcome == "ok"
+    print(f"{name:<16}  {outcome:<20}  {'ok' if passed else 'FAILED'}")
+    return passed
+
+
+async def main():
+    bot.api_session = create_api_session()
+    try:
+        results = [await check(*case) for case in CASES]
+    finally:
+        await bot.api_session.close()
+    return all(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
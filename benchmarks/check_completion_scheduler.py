@@ -0,0 +1,107 @@
+"""Checks that CompletionScheduler copes with queued requests that are
+cancelled before their tasks take them out of the queue, like superseded
+replies are: a release in the same tick, or a new request shedding one,
+must skip them instead of failing and leaving a slot taken for good.
+
+Each case holds the only slot, queues requests, cancels one and then
+expects the others to get the slot once it's released. Run from the
+repository root (a config.json is needed):
+
+    python -m benchmarks.check_completion_scheduler
+"""
+import asyncio
+import sys
+
+from shirt_bot_utils import CompletionQueueFull, CompletionScheduler, Priority
+
+GUILD = 1
+
+
+async def started(task):
+    """Returns whether the task got a slot, without waiting for it. Raises
+    what the task raised, if it failed."""
+
+    await asyncio.sleep(0)
+    return task.done() and task.result() is None
+
+
+async def released(scheduler):
+    waiting = asyncio.create_task(
+        scheduler.acquire(Priority.AMBIENT, GUILD, 1)
+    )
+    await asyncio.sleep(0)
+    waiting.cancel()
+    scheduler.release()
+    later = asyncio.create_task(scheduler.acquire(Priority.AMBIENT, GUILD, 1))
+    ok = await started(later)
+    await asyncio.gather(waiting, return_exceptions=True)
+    return ok and waiting.cancelled()
+
+
+async def shed(scheduler):
+    waiting = asyncio.create_task(
+        scheduler.acquire(Priority.AMBIENT, GUILD, 1)
+    )
+    await asyncio.sleep(0)
+    # The later request runs first, while the queue still looks full but
+    # the only request in it is cancelled.
+    later = asyncio.create_task(scheduler.acquire(Priority.COMMAND, GUILD, 1))
+    waiting.cancel()
+    await asyncio.sleep(0)
+    scheduler.release()
+    ok = await started(later)
+    await asyncio.gather(waiting, return_exceptions=True)
+    return ok and waiting.cancelled()
+
+
+async def shed_waiting(scheduler):
+    waiting = asyncio.create_task(
+        scheduler.acquire(Priority.AMBIENT, GUILD, 1)
+    )
+    await asyncio.sleep(0)
+    later = asyncio.create_task(scheduler.acquire(Priority.COMMAND, GUILD, 1))
+    await asyncio.sleep(0)
+    scheduler.release()
+    ok = await started(later)
+    result, = await asyncio.gather(waiting, return_exceptions=True)
+    return ok and isinstance(result, CompletionQueueFull)
+
+
+CASES = [
+    ("released", released),
+    ("shed", shed),
+    ("shed waiting", shed_waiting),
+]
+
+
+async def check(name, case):
+    scheduler = CompletionScheduler(
+        max_in_flight=1,
+        tokens_per_minute=0,
+        max_queue=1
+    )
+    await scheduler.acquire(Priority.COMMAND, GUILD, 1)
+    try:
+        ok = await case(scheduler)
+        outcome = "ok"
+    except Exception as e:
+        ok = False
+        outcome = type(e).__name__
+    passed = (
+        ok and scheduler.in_flight == 1 and scheduler.queued == 0
+    )
+    if ok and not passed:
+        outcome = (
+            f"in_flight={scheduler.in_flight} queued={scheduler.queued}"
+        )
+    print(f"{name:<14}  {outcome:<22}  {'ok' if passed else 'FAILED'}")
+    return passed
+
+
+async def main():
+    results = [await check(*case) for case in CASES]
+    return all(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
@@ -0,0 +1,54 @@
+"""Checks that the encoder produces exactly the token ids in
+encoder_golden.json and decodes them back to the original texts.
+
+The golden ids were made with the original GPT-3-Encoder implementation,
+so a faster encoder has to pass this to replace the current one. Run from
+the repository root:
+
+    python -m benchmarks.check_encoder_golden
+
+With --write the golden file is made again from the current encoder,
+which should only be done after adding texts, with an encoder that is
+known to be right.
+"""
+import json
+import sys
+
+from benchmarks.encoder_corpora import CORPORA
+from encoder import encoder
+
+GOLDEN_PATH = "benchmarks/encoder_golden.json"
+
+
+def write(enc):
+    golden = {
+        name: [[text, enc.encode(text)] for text in make()]
+        for name, make in CORPORA.items()
+    }
+    with open(GOLDEN_PATH, "w", encoding="utf-8") as file:
+        json.dump(golden, file, ensure_ascii=False, separators=(",", ":"))
+        file.write("\n")
+
+
+def check(enc):
+    with open(GOLDEN_PATH, encoding="utf-8") as file:
+        golden = json.load(file)
+    failures = 0
+    for name, cases in golden.items():
+        wrong = 0
+        for text, ids in cases:
+            if enc.encode(text) != ids or enc.decode(ids) != text:
+                wrong += 1
+                if wrong <= 3:
+                    print(f"  {name}: mismatch for {text[:60]!r}")
+        print(f"{name:<12}  {len(cases) - wrong}/{len(cases)} ok")
+        failures += wrong
+    return failures
+
+
+if __name__ == "__main__":
+    enc = encoder.get_encoder()
+    if "--write" in sys.argv[1:]:
+        write(enc)
+    else:
+        sys.exit(1 if check(enc) else 0)
@@ -0,0 +1,108 @@
+"""Deterministic text corpora for the encoder benchmark and golden check.
+
+Every corpus is a list of texts made from a fixed seed, so the same texts
+come out on every machine and Python version."""
+import random
+
+CHAT_WORDS = (
+    "lol lmao ok okay yeah yes no nah idk tbh imo brb gtg wtf omg bruh "
+    "the a an and or but so because if then what why how when where who "
+    "is are was were be been being do does did don't can't won't i'm "
+    "you're it's that's shirt bot hello hi hey thanks please sorry good bad "
+    "game games playing played server channel discord message messages "
+    "today tomorrow yesterday night morning 2 3 10 100 2023 :) :( :D xD"
+).split()
+EMOJI = "😀😂🤣😍😭👍🔥💀✨🎉❤️🙏👀🥺😎🤔"
+SCRIPTS = {
+    "cyrillic": (0x0410, 0x044F),
+    "greek": (0x0391, 0x03C9),
+    "arabic": (0x0621, 0x064A),
+    "devanagari": (0x0905, 0x0939),
+    "hiragana": (0x3041, 0x3093),
+    "cjk": (0x4E00, 0x9FFF),
+    "hangul": (0xAC00, 0xD7A3),
+}
+
+
+def chat(count=1000, seed=0):
+    """Discord-like "name: message" lines."""
+
+    rng = random.Random(seed)
+    names = [f"user{i}" for i in range(30)] + ["Shirt Bot"]
+    lines = []
+    for _ in range(count):
+        words = rng.choices(CHAT_WORDS, k=rng.randint(1, 25))
+        if rng.random() < 0.2:
+            words.append(rng.choice(EMOJI))
+        if rng.random() < 0.1:
+            words[0] = words[0].capitalize()
+        line = " ".join(words)
+        if rng.random() < 0.3:
+            line += rng.choice("?!.")
+        lines.append(f"{rng.choice(names)}: {line}")
+    return lines
+
+
+def emoji_runs(count=50, seed=0):
+    """Long runs of emoji, with and without spaces."""
+
+    rng = random.Random(seed)
+    return [
+        (" " if rng.random() < 0.5 else "").join(
+            rng.choices(EMOJI, k=rng.randint(50, 500))
+        )
+        for _ in range(count)
+    ]
+
+
+def huge_words(count=10, seed=0):
+    """Single words thousands of characters long."""
+
+    rng = random.Random(seed)
+    alphabets = ["a", "ab", "abcdefghijklmnopqrstuvwxyz", "0123456789", "aA"]
+    return [
+        "".join(rng.choices(rng.choice(alphabets), k=rng.randint(1000, 4000)))
+        for _ in range(count)
+    ]
+
+
+def non_latin(count=300, seed=0):
+    """Sentences in non-Latin scripts."""
+
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        low, high = SCRIPTS[rng.choice(sorted(SCRIPTS))]
+        words = [
+            "".join(
+                chr(rng.randint(low, high))
+                for _ in range(rng.randint(1, 8))
+            )
+            for _ in range(rng.randint(1, 20))
+        ]
+        texts.append(" ".join(words))
+    return texts
+
+
+def whitespace(count=100, seed=0):
+    """Runs of spaces, tabs and newlines between words."""
+
+    rng = random.Random(seed)
+    return [
+        "".join(
+            rng.choice(CHAT_WORDS) + "".join(
+                rng.choices(" \t\n", k=rng.randint(1, 30))
+            )
+            for _ in range(rng.randint(1, 20))
+        )
+        for _ in range(count)
+    ]
+
+
+CORPORA = {
+    "chat": chat,
+    "emoji runs": emoji_runs,
+    "huge words": huge_words,
+    "non-latin": non_latin,
+    "whitespace": whitespace,
+}
@@ -0,0 +1,411 @@
+"""SQLite storage for the channels Shirt Bot's modes are turned on in, and
+the ChannelSettings registry the bot keeps them in while it runs.
+
+Every channel with any setting has one row, which is upserted or deleted
+on its own when a setting changes, instead of rewriting a whole file. The
+database runs in WAL mode, so a write only appends to the journal.
+
+The old data/*.txt files are migrated into a new database when it's
+created, and can also be migrated by hand:
+
+    python channel_store.py data/shirt_bot.db data
+"""
+import array
+import collections
+import contextlib
+import os
+import sqlite3
+import sys
+
+SCHEMA_VERSION = 1
+
+# The columns of a channel's row, in the order load returns and save takes
+# them.
+COLUMNS = (
+    "channel_id", "guild_id", "talk", "reply", "random_randomness",
+    "random_chance", "uncensored_links"
+)
+
+# A channel's row is deleted once all of these are off.
+EMPTY_ROW = (
+    "talk IS NULL AND reply IS NULL AND random_randomness IS NULL "
+    "AND NOT uncensored_links"
+)
+
+
+class ChannelRecord(collections.namedtuple("ChannelRecord", COLUMNS[1:])):
+    """The settings of one channel, a row of COLUMNS without the channel id.
+    A setting that's off is None, except uncensored_links, which is 0.
+
+    Records are tuples, so channels with the same guild and settings share
+    one, and changing a setting replaces the channel's record."""
+
+    __slots__ = ()
+
+    @property
+    def random(self):
+        if self.random_randomness is None:
+            return None
+        return self.random_randomness, self.random_chance
+
+    def is_empty(self):
+        return (
+            self.talk is None and self.reply is None
+            and self.random_randomness is None and not self.uncensored_links
+        )
+
+
+EMPTY_RECORD = ChannelRecord(None, None, None, None, None, 0)
+
+
+class ChannelSettings:
+    """Every channel's ChannelRecord by channel id, with the ids of the
+    channels with settings in each guild.
+
+    Channels in DMs, and ones stored before guilds were, have the guild id
+    None and aren't in the guild index."""
+
+    def __init__(self):
+        self.records = {}
+        # Guild and settings -> the record every channel with them shares.
+        self.shared = {}
+        # Guild id -> array of channel ids. A guild has at most 500
+        # channels, so looking through one is cheap.
+        self.guilds = {}
+
+    @classmethod
+    def load(cls, rows):
+        """Makes the registry from rows of COLUMNS."""
+
+        settings = cls()
+        records = settings.records
+        shared = settings.shared
+        guilds = settings.guilds
+        for row in rows:
+            values = row[1:]
+            record = shared.get(values)
+            if record is None:
+                record = ChannelRecord._make(values)
+                shared[record] = record
+            records[row[0]] = record
+            if record.guild_id is not None:
+                channels = guilds.get(record.guild_id)
+                if channels is None:
+                    channels = guilds[record.guild_id] = array.array("q")
+                channels.append(row[0])
+        return settings
+
+    def dump(self):
+        """Returns every channel's settings as rows of COLUMNS."""
+
+        return [
+            (channel_id, *record)
+            for channel_id, record in self.records.items()
+        ]
+
+    def __contains__(self, channel_id):
+        return channel_id in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, channel_id):
+        return self.records.get(channel_id)
+
+    def setting(self, channel_id, name):
+        """Returns one of a channel's settings, raising KeyError if it's
+        off."""
+
+        value = getattr(self.records[channel_id], name)
+        if value is None:
+            raise KeyError(channel_id)
+        return value
+
+    def talk(self, channel_id):
+        record = self.records.get(channel_id)
+        return record.talk if record is not None else None
+
+    def reply(self, channel_id):
+        record = self.records.get(channel_id)
+        return record.reply if record is not None else None
+
+    def random(self, channel_id):
+        record = self.records.get(channel_id)
+        return record.random if record is not None else None
+
+    def uncensored_links(self, channel_id):
+        record = self.records.get(channel_id)
+        return record is not None and bool(record.uncensored_links)
+
+    def in_guild(self, guild_id):
+        """Returns the ids and records of the guild's channels with
+        settings."""
+
+        return [
+            (channel_id, self.records[channel_id])
+            for channel_id in self.guilds.get(guild_id, ())
+        ]
+
+    def _store(self, channel_id, record):
+        """Sets a channel's record, or forgets the channel if it's None,
+        and keeps the guild index up to date."""
+
+        old = self.records.get(channel_id)
+        old_guild = old.guild_id if old is not None else None
+        new_guild = record.guild_id if record is not None else None
+        if old_guild is not None and old_guild != new_guild:
+            channels = self.guilds[old_guild]
+            channels.remove(channel_id)
+            if not channels:
+                del self.guilds[old_guild]
+        if new_guild is not None and new_guild != old_guild:
+            self.guilds.setdefault(new_guild, array.array("q")).append(
+                channel_id
+            )
+
+        if record is None:
+            del self.records[channel_id]
+        else:
+            self.records[channel_id] = self.shared.setdefault(record, record)
+
+    def set_guild(self, channel_id, guild_id):
+        record = self.records[channel_id]
+        if record.guild_id != guild_id:
+            self._store(channel_id, record._replace(guild_id=guild_id))
+
+    def apply(self, operation, channel_id, randomness=None, chance=None,
+              guild_id=None):
+        """Applies one of the operations ChannelStore.apply takes."""
+
+        if operation == "SET_SHIRT_TALK":
+            changes = {"talk": randomness}
+        elif operation == "SET_SHIRT_REPLY":
+            changes = {"reply": randomness}
+        elif operation == "SET_SHIRT_RANDOM":
+            changes = {
+                "random_randomness": randomness,
+                "random_chance": chance
+            }
+        elif operation == "UNCENSOR_LINKS":
+            changes = {"uncensored_links": 1}
+        elif operation == "UNSET_SHIRT_TALK":
+            changes = {"talk": None}
+        elif operation == "UNSET_SHIRT_REPLY":
+            changes = {"reply": None}
+        elif operation == "UNSET_SHIRT_RANDOM":
+            changes = {"random_randomness": None, "random_chance": None}
+        elif operation == "CENSOR_LINKS":
+            changes = {"uncensored_links": 0}
+        else:
+            raise ValueError(f"Unknown operation {operation!r}.")
+
+        if guild_id is not None:
+            changes["guild_id"] = guild_id
+        old = self.records.get(channel_id)
+        record = (old or EMPTY_RECORD)._replace(**changes)
+        if not record.is_empty():
+            self._store(channel_id, record)
+        elif old is not None:
+            self._store(channel_id, None)
+
+    def remove(self, channel_id):
+        """Forgets every setting of a channel, returns whether it had
+        any."""
+
+        if channel_id not in self.records:
+            return False
+        self._store(channel_id, None)
+        return True
+
+
+class ChannelStore:
+    """The channel settings database at path.
+
+    If the database is new and text_directory is given, the text files in
+    it are migrated in the same transaction that creates the database."""
+
+    def __init__(self, path, text_directory=None):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only risks the latest writes on power loss.
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.migrated = 0
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            with self.transaction():
+                self.db.execute(
+                    "CREATE TABLE channels ("
+                    "channel_id INTEGER PRIMARY KEY, "
+                    "guild_id INTEGER, "
+                    "talk REAL, "
+                    "reply REAL, "
+                    "random_randomness REAL, "
+                    "random_chance REAL, "
+                    "uncensored_links INTEGER NOT NULL DEFAULT 0)"
+                )
+                self.db.execute(
+                    "CREATE INDEX channels_guild ON channels (guild_id)"
+                )
+                if text_directory is not None:
+                    self.migrated = self.migrate_text_files(text_directory)
+                self.db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the writes inside as one transaction."""
+
+        self.db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+    def load(self):
+        """Returns every channel's settings as rows of COLUMNS, for
+        ChannelSettings.load."""
+
+        return self.db.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM channels"
+        ).fetchall()
+
+    def save(self, rows):
+        """Stores rows of COLUMNS, like ChannelSettings.dump returns,
+        replacing the settings of the channels in them."""
+
+        self.db.executemany(
+            f"INSERT OR REPLACE INTO channels ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})",
+            rows
+        )
+
+    def _set(self, channel_id, **columns):
+        names = ", ".join(columns)
+        self.db.execute(
+            f"INSERT INTO channels (channel_id, {names}) "
+            f"VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT (channel_id) DO UPDATE SET "
+            + ", ".join(f"{name} = excluded.{name}" for name in columns),
+            (channel_id, *columns.values())
+        )
+
+    def _unset(self, channel_id, **columns):
+        self.db.execute(
+            "UPDATE channels SET "
+            + ", ".join(f"{name} = ?" for name in columns)
+            + " WHERE channel_id = ?",
+            (*columns.values(), channel_id)
+        )
+        self.db.execute(
+            f"DELETE FROM channels WHERE channel_id = ? AND {EMPTY_ROW}",
+            (channel_id,)
+        )
+
+    def apply(self, operation, channel_id, randomness=None, chance=None,
+              guild_id=None):
+        """Stores one of the operations SettingsWriter takes. guild_id is
+        stored with the settings that are turned on, if it's given."""
+
+        guild = {"guild_id": guild_id} if guild_id is not None else {}
+        if operation == "SET_SHIRT_TALK":
+            self._set(channel_id, talk=randomness, **guild)
+        elif operation == "SET_SHIRT_REPLY":
+            self._set(channel_id, reply=randomness, **guild)
+        elif operation == "SET_SHIRT_RANDOM":
+            self._set(
+                channel_id,
+                random_randomness=randomness,
+                random_chance=chance,
+                **guild
+            )
+        elif operation == "UNCENSOR_LINKS":
+            self._set(channel_id, uncensored_links=1, **guild)
+        elif operation == "UNSET_SHIRT_TALK":
+            self._unset(channel_id, talk=None)
+        elif operation == "UNSET_SHIRT_REPLY":
+            self._unset(channel_id, reply=None)
+        elif operation == "UNSET_SHIRT_RANDOM":
+            self._unset(
+                channel_id,
+                random_randomness=None,
+                random_chance=None
+            )
+        elif operation == "CENSOR_LINKS":
+            self._unset(channel_id, uncensored_links=0)
+        else:
+            raise ValueError(f"Unknown operation {operation!r}.")
+
+    def set_guilds(self, channel_guilds):
+        """Stores the guild ids of channels, from (channel id, guild id)
+        pairs."""
+
+        self.db.executemany(
+            "UPDATE channels SET guild_id = ? WHERE channel_id = ?",
+            ((guild_id, channel_id) for channel_id, guild_id in channel_guilds)
+        )
+
+    def remove_channels(self, channel_ids):
+        """Deletes every setting of the given channels."""
+
+        self.db.executemany(
+            "DELETE FROM channels WHERE channel_id = ?",
+            ((channel_id,) for channel_id in channel_ids)
+        )
+
+    def migrate_text_files(self, directory="data"):
+        """Copies the settings in the old text files in directory into the
+        database. Returns how many settings were copied."""
+
+        def lines(name):
+            path = os.path.join(directory, f"{name}.txt")
+            if not os.path.exists(path):
+                return []
+            with open(path) as file:
+                return [line.split() for line in file.read().split("\n")
+                        if line]
+
+        settings = ChannelSettings()
+        count = 0
+        for channel_id, randomness in lines("shirt_talk"):
+            settings.apply(
+                "SET_SHIRT_TALK",
+                int(channel_id),
+                float(randomness)
+            )
+            count += 1
+        for channel_id, randomness in lines("shirt_reply"):
+            settings.apply(
+                "SET_SHIRT_REPLY",
+                int(channel_id),
+                float(randomness)
+            )
+            count += 1
+        for channel_id, randomness, chance in lines("shirt_random"):
+            settings.apply(
+                "SET_SHIRT_RANDOM",
+                int(channel_id),
+                float(randomness),
+                float(chance)
+            )
+            count += 1
+        for channel_id, in lines("uncensored_links"):
+            settings.apply("UNCENSOR_LINKS", int(channel_id))
+            count += 1
+        self.save(settings.dump())
+        return count
+
+
+if __name__ == "__main__":
+    store = ChannelStore(
+        sys.argv[1] if len(sys.argv) > 1 else "data/shirt_bot.db"
+    )
+    with store.transaction():
+        migrated = store.migrate_text_files(
+            sys.argv[2] if len(sys.argv) > 2 else "data"
+        )
+    store.close()
+    print(f"Migrated {migrated} settings.")
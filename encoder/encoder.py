@@ -1,8 +1,12 @@
 # This file includes slightly modified
 # code from https://github.com/openai/gpt-2
 
+import heapq
 import json
+import threading
+
 import regex as re
+from collections import OrderedDict
 from functools import lru_cache
 
 
@@ -34,92 +38,206 @@ def get_pairs(word):
     return pairs
 
 
+class LRUCache:
+    """Mapping that forgets the least recently used entries once it holds
+    more than maxsize of them. Safe to share between threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors="replace"):
+    def __init__(self, encoder, bpe_merges, errors="replace",
+                 cache_size=2**16):
         self.encoder = encoder
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.errors = errors
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        # Table for str.translate, so the unicode stand-ins are mapped back
+        # to bytes in one C call instead of a Python loop. byte_encoder
+        # already works as a table for the other direction.
+        self.byte_decode_table = {
+            ord(c): b for b, c in self.byte_encoder.items()
+        }
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = LRUCache(cache_size)
         self.pat = re.compile(
             r"""'s|'t|'re|'ve|'m|'l l|'d| ?\p{L}+| """
             r"""?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
         )
 
+    def merge(self, token):
+        """Applies the BPE merges to a token and returns its parts.
+
+        Instead of rescanning the whole word for the lowest ranked pair after
+        every merge, candidate pairs are kept in a heap ordered by rank and
+        position, and the word is a linked list over the token's symbols, so
+        each merge only looks at its two new neighbouring pairs. Merges of
+        equal rank are popped left to right, which matches the reference
+        algorithm since a merged symbol only ever forms pairs of higher rank.
+        """
+
+        ranks = self.bpe_ranks
+        symbols = list(token)
+        n = len(symbols)
+        # Neighbours of each symbol, n and -1 meaning none.
+        next_ = list(range(1, n + 1))
+        prev = list(range(-1, n - 1))
+
+        heap = []
+        for i in range(n - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, symbols[i], symbols[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i, first, second = heapq.heappop(heap)
+            j = next_[i]
+            # Skip pairs which earlier merges have changed.
+            if j >= n or symbols[i] != first or symbols[j] != second:
+                continue
+
+            merged = first + second
+            symbols[i] = merged
+            symbols[j] = None
+            k = next_[j]
+            next_[i] = k
+            if k < n:
+                prev[k] = i
+                rank = ranks.get((merged, symbols[k]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, i, merged, symbols[k]))
+            p = prev[i]
+            if p >= 0:
+                rank = ranks.get((symbols[p], merged))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, p, symbols[p], merged))
+
+        return [symbol for symbol in symbols if symbol is not None]
+
+    def token_ids(self, token):
+        """Returns the token ids of a byte-encoded token, with caching."""
+
+        ids = self.cache.get(token)
+        if ids is None:
+            encoder = self.encoder
+            ids = tuple(encoder[part] for part in self.merge(token))
+            self.cache[token] = ids
+        return ids
+
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token
-
-        while True:
-            bigram = min(
-                pairs,
-                key=lambda pair: self.bpe_ranks.get(pair, float("inf"))
-            )
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except ValueError:
-                    new_word.extend(word[i:])
-                    break
-
-                if (
-                        word[i] == first
-                        and i < len(word) - 1
-                        and word[i + 1] == second
-                ):
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-
-        word = " ".join(word)
-        self.cache[token] = word
-        return word
+        decoder = self.decoder
+        return " ".join(decoder[i] for i in self.token_ids(token))
+
+    def word_ids(self, word):
+        """Returns the token ids of one word, as split by self.pat."""
+
+        word = word.encode("utf-8").decode("latin-1").translate(
+            self.byte_encoder
+        )
+        if len(word) == 1:
+            return (self.encoder[word],)
+        return self.token_ids(word)
 
     def encode(self, text):
         bpe_tokens = []
-        for token in re.findall(self.pat, text):
-            token = "".join(
-                self.byte_encoder[b]
-                for b
-                in token.encode("utf-8")
-            )
-
-            bpe_tokens.extend(
-                self.encoder[bpe_token]
-                for bpe_token
-                in
-                self.bpe(token).split(" ")
-            )
+        for word in self.pat.findall(text):
+            bpe_tokens.extend(self.word_ids(word))
 
         return bpe_tokens
 
+    def count_tokens(self, text):
+        """Returns len(self.encode(text)) without building the token list."""
+
+        return sum(len(self.word_ids(word)) for word in self.pat.findall(text))
+
+    def count_tokens_many(self, texts):
+        return [self.count_tokens(text) for text in texts]
+
+    def truncate(self, text, max_tokens, side="right"):
+        """Cuts text down to at most max_tokens tokens.
+
+        side is the side that gets cut off, so "right" keeps the start of
+        the text like decode(encode(text)[:max_tokens]) and "left" keeps the
+        end like decode(encode(text)[-max_tokens:]). Words are only decoded
+        if they're cut in half; everything else is sliced from the original
+        text, which is returned as is if it already fits."""
+
+        if max_tokens <= 0:
+            return ""
+        if side not in ("left", "right"):
+            raise ValueError(f'side must be "left" or "right", not {side!r}')
+
+        matches = self.pat.finditer(text)
+        if side == "left":
+            matches = reversed(list(matches))
+
+        count = 0
+        for match in matches:
+            ids = self.word_ids(match.group())
+            if count + len(ids) > max_tokens:
+                keep = max_tokens - count
+                if side == "right":
+                    return text[:match.start()] + self.decode(ids[:keep])
+                return (
+                    (self.decode(ids[-keep:]) if keep else "") +
+                    text[match.end():]
+                )
+            count += len(ids)
+
+        return text
+
     def decode(self, tokens):
         text = "".join([self.decoder[token] for token in tokens])
-        text = bytearray(
-            [self.byte_decoder[c] for c in text]
+        text = text.translate(self.byte_decode_table).encode(
+            "latin-1"
         ).decode(
             "utf-8",
             errors=self.errors
@@ -128,12 +246,69 @@ class Encoder:
         return text
 
 
-def get_encoder():
-    with open("encoder/encoder.json", "r") as f:
+ENCODER_PATH = "encoder/encoder.json"
+VOCAB_PATH = "encoder/vocab.bpe"
+
+
+def parse_tables():
+    with open(ENCODER_PATH, "r") as f:
         encoder = json.load(f)
-    with open("encoder/vocab.bpe", "r", encoding="utf-8") as f:
+    with open(VOCAB_PATH, "r", encoding="utf-8") as f:
         bpe_data = f.read()
     bpe_merges = [
         tuple(merge_str.split()) for merge_str in bpe_data.split("\n")[1:-1]
     ]
-    return Encoder(encoder=encoder, bpe_merges=bpe_merges)
+    return encoder, bpe_merges
+
+
+def get_encoder(cache_size=2**16):
+    encoder, bpe_merges = parse_tables()
+    return Encoder(
+        encoder=encoder,
+        bpe_merges=bpe_merges,
+        cache_size=cache_size
+    )
+
+
+# The encoder of a tokenizer worker process, see init_worker.
+_worker_encoder = None
+
+
+def init_worker(cache_size=2**16):
+    """Loads the encoder of a worker process, so it's warm before the
+    process gets its first job."""
+
+    global _worker_encoder
+    _worker_encoder = get_encoder(cache_size)
+
+
+def call_worker(method, *args):
+    """Calls a method of the worker process' encoder."""
+
+    return getattr(_worker_encoder, method)(*args)
+
+
+class LazyEncoder:
+    """Stands in for an Encoder which is only loaded when it's first used.
+
+    load can also be called ahead of time, e.g. from a background thread.
+    """
+
+    def __init__(self, cache_size=2**16):
+        self.cache_size = cache_size
+        self._encoder = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._encoder is None:
+            with self._lock:
+                if self._encoder is None:
+                    self._encoder = get_encoder(self.cache_size)
+        return self._encoder
+
+    @property
+    def loaded(self):
+        return self._encoder is not None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
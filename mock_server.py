@@ -0,0 +1,134 @@
+"""A stand-in for the completions API, for benchmarks and for trying out
+failure handling without spending tokens.
+
+Every request gets the next status from a script, or once the script runs
+out, a 200 or a 500 with the chance of error_rate. Streaming requests get
+the text a word at a time as server-sent events. Run it on its own with:
+
+    python mock_server.py --port 8080 --script 429,500,500 --retry-after 1
+
+The bot itself can also start one, see the "mock" backend in the README.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+
+from aiohttp import web
+
+
+class MockAPI:
+    """Answers completion requests with scripted statuses."""
+
+    def __init__(self, script=(), *, retry_after=None, latency=0.0,
+                 text=" shirt", repeat=False, chunk_delay=0.0,
+                 error_rate=0.0, seed=None):
+        self.script = itertools.cycle(script) if repeat else iter(script)
+        self.retry_after = retry_after
+        self.latency = latency
+        self.text = text
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.statuses = []
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        status = next(self.script, None)
+        if status is None:
+            failed = self.random.random() < self.error_rate
+            status = 500 if failed else 200
+        self.statuses.append(status)
+        if status == 200 and body.get("stream"):
+            return await self.stream(request)
+        if status == 200:
+            prompts = body.get("prompt", "")
+            count = len(prompts) if isinstance(prompts, list) else 1
+            return web.json_response({"choices": [
+                {"text": self.text, "index": i, "finish_reason": "stop"}
+                for i in range(count * body.get("n", 1))
+            ]})
+        headers = {}
+        if status == 429 and self.retry_after is not None:
+            headers["Retry-After"] = str(self.retry_after)
+        return web.json_response(
+            {"error": {"message": f"mock error {status}"}},
+            status=status, headers=headers
+        )
+
+    async def stream(self, request):
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"}
+        )
+        await response.prepare(request)
+        try:
+            for chunk in re.findall(r"\s*\S+|\s+", self.text):
+                event = {"choices": [{"text": chunk, "index": 0}]}
+                await response.write(
+                    f"data: {json.dumps(event)}\n\n".encode()
+                )
+                if self.chunk_delay:
+                    await asyncio.sleep(self.chunk_delay)
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # The client stopped reading early.
+            pass
+        return response
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/{path:.*}", self.handle)
+        return app
+
+
+async def start(mock, host="127.0.0.1", port=0):
+    """Starts serving mock in the running event loop, returns the runner
+    (call its cleanup method to stop) and the base URL."""
+
+    runner = web.AppRunner(mock.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--script", default="",
+        help="comma separated statuses to answer with before 200s"
+    )
+    parser.add_argument("--repeat", action="store_true",
+                        help="loop the script forever")
+    parser.add_argument("--retry-after", type=float,
+                        help="Retry-After seconds sent with 429s")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before answering")
+    parser.add_argument("--chunk-delay", type=float, default=0.0,
+                        help="seconds between streamed words")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="chance of answering with a 500")
+    parser.add_argument("--text", default=" shirt",
+                        help="the completion to answer with")
+    args = parser.parse_args()
+
+    mock = MockAPI(
+        [int(s) for s in args.script.split(",") if s],
+        retry_after=args.retry_after, latency=args.latency,
+        repeat=args.repeat, chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate, text=args.text
+    )
+    web.run_app(mock.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
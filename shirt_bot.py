@@ -20,6 +20,13 @@ from shirt_bot_utils import *
 async def on_ready():
     print('Ready')
 
+    # Messages sent while the bot was disconnected are missing from the
+    # transcripts, so they have to be fetched again.
+    for transcript in transcripts.values():
+        transcript.invalidate()
+
+    assign_guilds()
+
     await bot.change_presence(
         activity=discord.Activity(
             name=NAME,
@@ -29,27 +36,90 @@ async def on_ready():
 
 
 @bot.listen("on_message")
-async def shirt_talk_on_message(message):
-    """Event listener that handles shirt talk channels."""
+async def dispatch_on_message(message):
+    """Event listener that sends messages to the shirt talk, shirt reply
+    and shirt random handlers."""
 
     await bot.wait_until_ready()
 
-    ctx = await bot.get_context(message)
+    record_message(message)
+    route = route_message(message)
+    if route == Route.IGNORE:
+        return
+
+    with tracer.trace(route.value, message.id):
+        with span("get_context"):
+            ctx = await bot.get_context(message)
+        if route == Route.SHIRT_TALK:
+            await handle_shirt_talk(ctx)
+        elif route == Route.SHIRT_REPLY:
+            await handle_shirt_reply(ctx)
+        elif route == Route.SHIRT_RANDOM:
+            await handle_shirt_random(ctx)
+
+
+@bot.listen("on_message_edit")
+async def transcript_on_message_edit(before, after):
+    """Event listener that updates edited messages in transcripts."""
+
+    record_edit(after)
+
+
+@bot.listen("on_raw_message_edit")
+async def transcript_on_raw_message_edit(payload):
+    """Event listener that invalidates transcripts when a message that isn't
+    cached anymore gets edited."""
 
-    # Cases where shirt talk doesn't need to trigger:
-    #  - the message is a command
-    #  - the message author is a bot
-    #  - the message is a system message
-    #  - channel is not a shirt talk channel
-    #  - message is a non-triggering message
+    transcript = transcripts.get(payload.channel_id)
     if (
-        ctx.valid or
-        message.author.bot or
-        message.type != discord.MessageType.default or
-        message.channel.id not in shirt_talk_channels or
-        message.content.startswith("# ")
+        payload.cached_message is None and
+        transcript is not None and
+        payload.message_id in transcript
     ):
-        return
+        transcript.invalidate()
+
+
+@bot.listen("on_raw_message_delete")
+async def transcript_on_raw_message_delete(payload):
+    """Event listener that removes deleted messages from transcripts."""
+
+    record_deletes(payload.channel_id, [payload.message_id])
+
+
+@bot.listen("on_raw_bulk_message_delete")
+async def transcript_on_raw_bulk_message_delete(payload):
+    """Event listener that removes bulk deleted messages from transcripts."""
+
+    record_deletes(payload.channel_id, payload.message_ids)
+
+
+@bot.listen("on_guild_channel_delete")
+async def settings_on_guild_channel_delete(channel):
+    """Event listener that forgets the settings of deleted channels."""
+
+    settings_writer.forget((channel.id,))
+
+
+@bot.listen("on_private_channel_delete")
+async def settings_on_private_channel_delete(channel):
+    """Event listener that forgets the settings of deleted private
+    channels."""
+
+    settings_writer.forget((channel.id,))
+
+
+@bot.listen("on_guild_remove")
+async def settings_on_guild_remove(guild):
+    """Event listener that forgets the settings of the channels of guilds
+    the bot leaves."""
+
+    settings_writer.forget(channel.id for channel in guild.channels)
+
+
+async def handle_shirt_talk(ctx):
+    """Handles messages in shirt talk channels."""
+
+    message = ctx.message
 
     perms = message.channel.permissions_for(ctx.guild.me) if ctx.guild else None
     if (message.guild and not perms.read_message_history):
@@ -88,34 +158,46 @@ async def shirt_talk_on_message(message):
     except discord.Forbidden:
         return
 
-    async with message.channel.typing():
+    async def generate():
+        async with message.channel.typing():
 
-        collected_messages = await collect_messages(
-            message.channel,
-            mode=MessageCollectionType.SHIRT_TALK,
-            before=message
-        )
-        # If the message doesn't get deleted, include it in the prompt.
-        if reference is not None:
-            collected_messages.append(
-                f"{message.author.name}: "
-                f"{message.content}"
+            collected_messages = await collect_messages(
+                message.channel,
+                mode=MessageCollectionType.SHIRT_TALK,
+                before=message
             )
-        collected_messages = '\n'.join(collected_messages)
-
-        prompt = (
-            f"{collected_messages}\n"
-            f"{NAME}:{forced_prompt}"
-        )
-        try:
-            response_text = await send_prompt(
+            # If the message doesn't get deleted, include it in the prompt.
+            if reference is not None:
+                collected_messages.append(
+                    f"{message.author.name}: "
+                    f"{message.content}"
+                )
+            prompt, prompt_tokens = await build_prompt(
+                collected_messages,
+                f"{NAME}:{forced_prompt}",
+                100
+            )
+            return await send_prompt(
                 prompt,
                 100,
-                shirt_talk_channels[message.channel.id]/50,
+                channel_settings.setting(message.channel.id, "talk")/50,
+                prompt_tokens=prompt_tokens,
+                priority=Priority.CONVERSATION,
+                guild_id=ctx.guild.id if ctx.guild else None
             )
-        except (IndexError, KeyError):
-            # The API didn't return any text.
-            return
+
+    try:
+        response_text = await reply_scheduler.run(
+            message.channel.id,
+            Route.SHIRT_TALK,
+            generate
+        )
+    except (IndexError, KeyError, CompletionError):
+        # The API didn't return any text.
+        return
+    if response_text is None:
+        # A newer message in the channel is getting the reply instead.
+        return
 
     with contextlib.suppress(discord.Forbidden, discord.HTTPException):
         await ctx.shirt_send(
@@ -124,37 +206,10 @@ async def shirt_talk_on_message(message):
         )
 
 
-@bot.listen("on_message")
-async def shirt_reply_on_message(message):
-    """Event listener that handles shirt reply channels."""
+async def handle_shirt_reply(ctx):
+    """Handles replies to Shirt Bot in shirt reply channels."""
 
-    await bot.wait_until_ready()
-
-    ctx = await bot.get_context(message)
-
-    # Cases where shirt reply doesn't need to trigger:
-    #  - the message is a command
-    #  - the message author is a bot
-    #  - the message is a system message
-    #  - messsage doesn't reply to anyone
-    #  - message is in a Shirt Talk channel
-    #  - message is not in a shirt reply channel
-    #  - message doesn't reply to Shirt Bot
-    if (
-        ctx.valid or
-        message.author.bot or
-        message.type != discord.MessageType.default or
-        not message.reference or
-        message.channel.id in shirt_talk_channels or
-        message.channel.id not in shirt_reply_channels
-    ):
-        return
-    ref_message = message.reference.resolved if message.reference else None
-    if ref_message is None or (
-        isinstance(ref_message, discord.DeletedReferencedMessage) or
-        ref_message.author != bot.user
-    ):
-        return
+    message = ctx.message
 
     perms = message.channel.permissions_for(ctx.guild.me) if ctx.guild else None
     if message.guild and not perms.read_message_history:
@@ -192,34 +247,46 @@ async def shirt_reply_on_message(message):
     except discord.Forbidden:
         return
 
-    async with message.channel.typing():
+    async def generate():
+        async with message.channel.typing():
 
-        collected_messages = await collect_messages(
-            message.channel,
-            mode=MessageCollectionType.SHIRT_REPLY,
-            before=message,
-        )
-        # If the message doesn't get deleted, include it in the prompt.
-        if reference is not None:
-            collected_messages.append(
-                f"{message.author.name}: "
-                f"{message.content}"
+            collected_messages = await collect_messages(
+                message.channel,
+                mode=MessageCollectionType.SHIRT_REPLY,
+                before=message,
             )
-        collected_messages = '\n'.join(collected_messages)
-
-        prompt = (
-            f"{collected_messages}\n"
-            f"{NAME}:{forced_prompt}"
-        )
-        try:
-            response_text = await send_prompt(
+            # If the message doesn't get deleted, include it in the prompt.
+            if reference is not None:
+                collected_messages.append(
+                    f"{message.author.name}: "
+                    f"{message.content}"
+                )
+            prompt, prompt_tokens = await build_prompt(
+                collected_messages,
+                f"{NAME}:{forced_prompt}",
+                100
+            )
+            return await send_prompt(
                 prompt,
                 100,
-                shirt_reply_channels[message.channel.id]/50,
+                channel_settings.setting(message.channel.id, "reply")/50,
+                prompt_tokens=prompt_tokens,
+                priority=Priority.CONVERSATION,
+                guild_id=ctx.guild.id if ctx.guild else None
             )
-        except (IndexError, KeyError):
-            # The API didn't return any text.
-            return
+
+    try:
+        response_text = await reply_scheduler.run(
+            message.channel.id,
+            Route.SHIRT_REPLY,
+            generate
+        )
+    except (IndexError, KeyError, CompletionError):
+        # The API didn't return any text.
+        return
+    if response_text is None:
+        # A newer message in the channel is getting the reply instead.
+        return
 
     with contextlib.suppress(discord.Forbidden, discord.HTTPException):
         await ctx.shirt_send(
@@ -228,36 +295,10 @@ async def shirt_reply_on_message(message):
         )
 
 
-@bot.listen("on_message")
-async def shirt_random_on_message(message):
-    """Event listener that handles shirt random channels."""
-
-    await bot.wait_until_ready()
+async def handle_shirt_random(ctx):
+    """Handles messages in shirt random channels."""
 
-    ctx = await bot.get_context(message)
-
-    # Cases where shirt random doesn't need to trigger:
-    #  - the message is a command
-    #  - the message author is a bot
-    #  - the message is a system message
-    #  - message is in a shirt talk channel
-    #  - message is not in a shirt random channel
-    #  - message replies to Shirt Bot in a shirt reply channel
-    #  - random check fails (check done after permission check)
-    if (
-        ctx.valid or
-        ctx.author.bot or
-        message.type != discord.MessageType.default or
-        ctx.channel.id in shirt_talk_channels or
-        ctx.channel.id not in shirt_random_channels
-    ):
-        return
-    ref_message = message.reference.resolved if message.reference else None
-    if ctx.channel.id in shirt_reply_channels and ref_message is not None and (
-        not isinstance(ref_message, discord.DeletedReferencedMessage) and
-        ref_message.author == bot.user
-    ):
-        return
+    message = ctx.message
 
     perms = ctx.channel.permissions_for(ctx.guild.me) if ctx.guild else None
     if ctx.guild and not perms.read_message_history:
@@ -268,7 +309,8 @@ async def shirt_random_on_message(message):
             )
             return
 
-    if random.uniform(0, 100) >= shirt_random_channels[ctx.channel.id][1]:
+    chance = channel_settings.setting(ctx.channel.id, "random")[1]
+    if random.uniform(0, 100) >= chance:
         return
 
     try:
@@ -276,27 +318,39 @@ async def shirt_random_on_message(message):
     except discord.Forbidden:
         return
 
-    async with ctx.channel.typing():
+    async def generate():
+        async with ctx.channel.typing():
 
-        collected_messages = await collect_messages(
-            ctx.channel,
-            mode=MessageCollectionType.TRIGGER_OR_SHIRT_RANDOM
-        )
-        collected_messages = '\n'.join(collected_messages)
-
-        prompt = (
-            f"{collected_messages}\n"
-            f"{NAME}:"
-        )
-        try:
-            response_text = await send_prompt(
+            collected_messages = await collect_messages(
+                ctx.channel,
+                mode=MessageCollectionType.TRIGGER_OR_SHIRT_RANDOM
+            )
+            prompt, prompt_tokens = await build_prompt(
+                collected_messages,
+                f"{NAME}:",
+                100
+            )
+            return await send_prompt(
                 prompt,
                 100,
-                shirt_random_channels[message.channel.id][0]/50,
+                channel_settings.setting(message.channel.id, "random")[0]/50,
+                prompt_tokens=prompt_tokens,
+                priority=Priority.AMBIENT,
+                guild_id=ctx.guild.id if ctx.guild else None
             )
-        except (IndexError, KeyError):
-            # The API didn't return any text.
-            return
+
+    try:
+        response_text = await reply_scheduler.run(
+            message.channel.id,
+            Route.SHIRT_RANDOM,
+            generate
+        )
+    except (IndexError, KeyError, CompletionError):
+        # The API didn't return any text.
+        return
+    if response_text is None:
+        # A newer message in the channel is getting the reply instead.
+        return
 
     with contextlib.suppress(discord.Forbidden, discord.HTTPException):
         await ctx.shirt_send(
@@ -345,6 +399,7 @@ async def echo_cmd(ctx, *, text):
 
 # ### API Commands ###
 @bot.command(name="trigger")
+@traced
 async def bot_trigger(
     ctx,
     max_size: typing.Optional[int] = 80,
@@ -369,27 +424,40 @@ async def bot_trigger(
         )
         return
 
+    # Streamed, reading stops as soon as the first line is complete.
+    reply = ProgressiveReply(ctx, text) if STREAM_COMPLETIONS else None
     async with ctx.channel.typing():
         collected_messages = await collect_messages(
             ctx.channel,
             mode=MessageCollectionType.TRIGGER_OR_SHIRT_RANDOM
         )
-        collected_messages = '\n'.join(collected_messages)
-        prompt = f"{collected_messages}\n{NAME}:{' ' if text else ''}{text}"
+        prompt, prompt_tokens = await build_prompt(
+            collected_messages,
+            f"{NAME}:{' ' if text else ''}{text}",
+            max_size
+        )
         try:
             response_text = await send_prompt(
                 prompt,
                 max_size,
                 randomness/50,
+                prompt_tokens=prompt_tokens,
+                guild_id=ctx.guild.id if ctx.guild else None,
+                on_text=reply.update if reply else None
             )
-        except (IndexError, KeyError):
+        except (IndexError, KeyError, CompletionError):
             # In case we get no text from the API.
-            response_text = ""
+            # A streamed reply keeps what arrived before the error.
+            response_text = reply.text if reply else ""
 
+    if reply:
+        await reply.finish(response_text)
+        return
     await ctx.shirt_send(f"{text}{response_text}", reference=ctx.message)
 
 
 @bot.command(name="generate", aliases=["instruct"])
+@traced
 async def bot_generate_instruct(
     ctx,
     max_size: typing.Optional[int] = 80,
@@ -405,6 +473,7 @@ async def bot_generate_instruct(
         await ctx.send(f"Max size has to be between 1 and {TOKEN_LIMIT}.")
         return
 
+    reply = ProgressiveReply(ctx, text) if STREAM_COMPLETIONS else None
     async with ctx.channel.typing():
         try:
             response_text = await send_prompt(
@@ -413,12 +482,18 @@ async def bot_generate_instruct(
                 randomness/50,
                 decrease_max=True,
                 first_line=False,
-                instruct=(ctx.invoked_with == "instruct")
+                instruct=(ctx.invoked_with == "instruct"),
+                guild_id=ctx.guild.id if ctx.guild else None,
+                on_text=reply.update if reply else None
             )
-        except (IndexError, KeyError):
+        except (IndexError, KeyError, CompletionError):
             # In case we get no text from the API.
-            response_text = ""
+            # A streamed reply keeps what arrived before the error.
+            response_text = reply.text if reply else ""
 
+    if reply:
+        await reply.finish(response_text)
+        return
     await ctx.shirt_send(f"{text}{response_text}", reference=ctx.message)
 
 
@@ -430,20 +505,20 @@ async def shirt_talk(ctx):
     if ctx.guild:
         channels = '\n'.join([
             f"{channel.mention} ({channel.id})\n"
-            f"  randomness: {shirt_talk_channels[channel.id]}" for
-            channel in
-            ctx.guild.text_channels if
-            channel.id in shirt_talk_channels
+            f"  randomness: {record.talk}" for
+            channel, record in
+            guild_channel_settings(ctx.guild) if
+            record.talk is not None
         ])
         if channels:
             await ctx.send(f"List of shirt talk channels:\n\n{channels}")
             return
         await ctx.send("This server doesn't have any shirt talk channels.")
         return
-    elif ctx.channel.id in shirt_talk_channels:
+    elif channel_settings.talk(ctx.channel.id) is not None:
         await ctx.send(
             f"This DM channel is a shirt talk channel with "
-            f"randomness {shirt_talk_channels[ctx.channel.id]}."
+            f"randomness {channel_settings.talk(ctx.channel.id)}."
         )
         return
     await ctx.send("This DM channel is not a shirt talk channel.")
@@ -464,12 +539,13 @@ async def shirt_talk_set(
 
     channel = channel or ctx.channel
 
-    await bot.queue.put((
+    settings_writer.submit(
         "SET_SHIRT_TALK",
         channel.id,
         randomness,
-        None
-    ))
+        None,
+        ctx.guild.id if ctx.guild else None
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     await ctx.send(f"Shirt talk randomness{channelstr} set to {randomness}%.")
@@ -483,16 +559,16 @@ async def shirt_talk_unset(ctx, channel: CustomTextChannelConverter = None):
     channel = channel or ctx.channel
     channelstr = channel.mention if channel != ctx.channel else "This channel"
 
-    if channel.id not in shirt_talk_channels:
+    if channel_settings.talk(channel.id) is None:
         await ctx.send(f"{channelstr} is not a shirt talk channel.")
         return
 
-    await bot.queue.put((
+    settings_writer.submit(
         "UNSET_SHIRT_TALK",
         channel.id,
         None,
         None
-    ))
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     await ctx.send(f"Shirt talk turned off{channelstr}.")
@@ -506,20 +582,20 @@ async def shirt_reply(ctx):
     if ctx.guild:
         channels = '\n'.join([
             f"{channel.mention} ({channel.id})\n"
-            f"  randomness: {shirt_reply_channels[channel.id]}%" for
-            channel in
-            ctx.guild.text_channels if
-            channel.id in shirt_reply_channels
+            f"  randomness: {record.reply}%" for
+            channel, record in
+            guild_channel_settings(ctx.guild) if
+            record.reply is not None
         ])
         if channels:
             await ctx.send(f"List of shirt reply channels:\n\n{channels}")
             return
         await ctx.send("This server doesn't have any shirt reply channels.")
         return
-    elif ctx.channel.id in shirt_reply_channels:
+    elif channel_settings.reply(ctx.channel.id) is not None:
         await ctx.send(
             f"This DM channel is a shirt reply channel with "
-            f"randomness {shirt_reply_channels[ctx.channel.id]}%."
+            f"randomness {channel_settings.reply(ctx.channel.id)}%."
         )
         return
     await ctx.send("This DM channel is not a shirt reply channel.")
@@ -540,12 +616,13 @@ async def shirt_reply_set(
 
     channel = channel or ctx.channel
 
-    await bot.queue.put((
+    settings_writer.submit(
         "SET_SHIRT_REPLY",
         channel.id,
         randomness,
-        None
-    ))
+        None,
+        ctx.guild.id if ctx.guild else None
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     await ctx.send(f"Shirt reply randomness{channelstr} set to {randomness}%.")
@@ -559,16 +636,16 @@ async def shirt_reply_unset(ctx, channel: CustomTextChannelConverter = None):
     channel = channel or ctx.channel
     channelstr = channel.mention if channel != ctx.channel else "This channel"
 
-    if channel.id not in shirt_reply_channels:
+    if channel_settings.reply(channel.id) is None:
         await ctx.send(f"{channelstr} is not a shirt reply channel.")
         return
 
-    await bot.queue.put((
+    settings_writer.submit(
         "UNSET_SHIRT_REPLY",
         channel.id,
         None,
         None
-    ))
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     await ctx.send(f"Shirt reply turned off{channelstr}.")
@@ -582,22 +659,23 @@ async def shirt_random(ctx):
     if ctx.guild:
         channels = '\n'.join([
             f"{channel.mention} ({channel.id})\n"
-            f"  randomness: {shirt_random_channels[channel.id][0]}%\n"
-            f"  chance: {shirt_random_channels[channel.id][1]}%" for
-            channel in
-            ctx.guild.text_channels if
-            channel.id in shirt_random_channels
+            f"  randomness: {record.random[0]}%\n"
+            f"  chance: {record.random[1]}%" for
+            channel, record in
+            guild_channel_settings(ctx.guild) if
+            record.random is not None
         ])
         if channels:
             await ctx.send(f"List of shirt random channels:\n\n{channels}")
             return
         await ctx.send("This server doesn't have any shirt random channels.")
         return
-    elif ctx.channel.id in shirt_random_channels:
+    elif channel_settings.random(ctx.channel.id) is not None:
+        randomness, chance = channel_settings.random(ctx.channel.id)
         await ctx.send(
             f"This DM channel is a shirt random channel with "
-            f"randomness {shirt_random_channels[ctx.channel.id][0]}% and "
-            f"chance {shirt_random_channels[ctx.channel.id][1]}%."
+            f"randomness {randomness}% and "
+            f"chance {chance}%."
         )
         return
     await ctx.send("This DM channel is not a shirt random channel.")
@@ -622,12 +700,13 @@ async def shirt_random_set(
 
     channel = channel or ctx.channel
 
-    await bot.queue.put((
+    settings_writer.submit(
         "SET_SHIRT_RANDOM",
         channel.id,
         randomness,
-        chance
-    ))
+        chance,
+        ctx.guild.id if ctx.guild else None
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     await ctx.send(
@@ -645,16 +724,16 @@ async def shirt_random_unset(ctx, channel: CustomTextChannelConverter = None):
     channel = channel or ctx.channel
     channelstr = channel.mention if channel != ctx.channel else "This channel"
 
-    if channel.id not in shirt_random_channels:
+    if channel_settings.random(channel.id) is None:
         await ctx.send(f"{channelstr} is not a shirt random channel.")
         return
 
-    await bot.queue.put((
+    settings_writer.submit(
         "UNSET_SHIRT_RANDOM",
         channel.id,
         None,
         None
-    ))
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     await ctx.send(f"Shirt random turned off{channelstr}.")
@@ -668,9 +747,9 @@ async def links(ctx):
     if ctx.guild:
         channels = '\n'.join([
             f"  {channel.mention} ({channel.id})" for
-            channel in
-            ctx.guild.text_channels if
-            channel.id in uncensored_link_channels
+            channel, record in
+            guild_channel_settings(ctx.guild) if
+            record.uncensored_links
         ])
         if channels:
             await ctx.send(f"Channels with uncensored links:\n{channels}")
@@ -680,7 +759,7 @@ async def links(ctx):
             "channels with uncensored links."
         )
         return
-    elif ctx.channel.id in uncensored_link_channels:
+    elif channel_settings.uncensored_links(ctx.channel.id):
         await ctx.send(f"This DM channel has uncensored links.")
         return
     await ctx.send("This DM channel has censored links.")
@@ -694,17 +773,18 @@ async def links_toggle(ctx, channel: CustomTextChannelConverter = None):
     channel = channel or ctx.channel
     channelstr = channel.mention if channel != ctx.channel else "This channel"
 
-    if channel.id in uncensored_link_channels:
+    if channel_settings.uncensored_links(channel.id):
         op = "CENSOR_LINKS"
     else:
         op = "UNCENSOR_LINKS"
 
-    await bot.queue.put((
+    settings_writer.submit(
         op,
         channel.id,
         None,
-        None
-    ))
+        None,
+        ctx.guild.id if ctx.guild else None
+    )
 
     channelstr = f" for {channel.mention}" if channel != ctx.channel else ""
     if op == "CENSOR_LINKS":
@@ -713,6 +793,91 @@ async def links_toggle(ctx, channel: CustomTextChannelConverter = None):
     await ctx.send(f"Links uncensored{channelstr}.")
 
 
+# ### Owner Commands ###
+@commands.is_owner()
+@bot.group(name="stats", hidden=True, invoke_without_command=True)
+async def stats(ctx):
+    """Lists the available statistics."""
+
+    subcommands = ', '.join(sorted(c.name for c in stats.commands))
+    await ctx.send(f"Available statistics: {subcommands}")
+
+
+@commands.is_owner()
+@stats.command(name="http")
+async def stats_http(ctx):
+    """Shows how the API session's connection pool is used."""
+
+    await ctx.send(format_stats(pool_stats.as_dict()))
+
+
+@commands.is_owner()
+@stats.command(name="api")
+async def stats_api(ctx):
+    """Shows API response statuses, retries and the circuit breaker."""
+
+    await ctx.send(format_stats(api_stats_dict()))
+
+
+@commands.is_owner()
+@stats.command(name="cache")
+async def stats_cache(ctx):
+    """Shows how often the response cache is used and what it saved."""
+
+    await ctx.send(format_stats(response_cache.as_dict()))
+
+
+@commands.is_owner()
+@stats.command(name="traces")
+async def stats_traces(ctx):
+    """Shows where the slowest replies spent their time."""
+
+    await ctx.send(format_stats(tracer.breakdown()))
+
+
+@commands.is_owner()
+@stats.command(name="completions")
+async def stats_completions(ctx):
+    """Shows the completion scheduler's load."""
+
+    await ctx.send(format_stats({
+        **completion_scheduler.as_dict(),
+        **completion_batcher.as_dict()
+    }))
+
+
+@commands.is_owner()
+@stats.command(name="encoder")
+async def stats_encoder(ctx):
+    """Shows how well the encoder's word cache works."""
+
+    await ctx.send(format_stats(ENCODER.cache.stats()))
+
+
+@commands.is_owner()
+@stats.command(name="loop")
+async def stats_loop(ctx):
+    """Shows the event loop's lag and where tokenizing ran."""
+
+    await ctx.send(format_stats({**loop_lag.stats(), **tokenizer.stats()}))
+
+
+@commands.is_owner()
+@stats.command(name="scheduling")
+async def stats_scheduling(ctx):
+    """Shows how many replies bursts of messages saved."""
+
+    await ctx.send(format_stats(dict(reply_scheduler.stats)))
+
+
+@commands.is_owner()
+@stats.command(name="routes")
+async def stats_routes(ctx):
+    """Shows where the message dispatcher sent messages."""
+
+    await ctx.send(format_stats(routing_stats()))
+
+
 # ######################
 # ### Error Handlers ###
 # ######################
@@ -722,6 +887,7 @@ async def on_command_error(ctx, error):
     error = getattr(error, "original", error)
     ignored = (
         commands.CommandNotFound,
+        commands.NotOwner,
         commands.TooManyArguments,
         discord.Forbidden,
         discord.HTTPException
@@ -779,5 +945,5 @@ async def error__links_toggle(ctx, error):
 # ### Running The Bot ###
 # #######################
 
-bot.run(TOKEN)
-update_data_files.stop()
\ No newline at end of file
+if __name__ == "__main__":
+    bot.run(TOKEN)
\ No newline at end of file
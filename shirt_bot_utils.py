@@ -1,16 +1,32 @@
 import asyncio
+import bisect
+import collections
+import concurrent.futures
 import contextlib
+import contextvars
+import email.utils
+import functools
+import hashlib
+import heapq
+import itertools
+import logging
+import logging.handlers
+import sqlite3
 import traceback
 import enum
 import json
 import os
+import random
 import re
 import sys
+import time
 
 import aiohttp
 import discord
+from aiohttp import web
 from discord.ext import commands, tasks
 
+import channel_store
 from encoder import encoder
 
 # ################################
@@ -24,6 +40,143 @@ TOKEN = config["token"] or os.getenv("token")
 PREFIX = config["prefix"] or os.getenv("prefix")
 NAME = config["name"] or os.getenv("name")
 
+# Where the channel settings are stored, see channel_store, and how often
+# and how many changes are written at once, see SettingsWriter.
+DATABASE_PATH = config.get("database_path", "data/shirt_bot.db")
+DATA_FLUSH_INTERVAL = config.get("data_flush_interval", 1.0)
+DATA_MAX_BATCH = config.get("data_max_batch", 500)
+
+# How often the settings of guild channels the bot can't see anymore are
+# looked for, in seconds (0 turns it off), and how many channels are looked
+# at before letting other tasks run, see reconcile_channels.
+CHANNEL_RECONCILE_INTERVAL = config.get("channel_reconcile_interval", 3600)
+CHANNEL_RECONCILE_CHUNK = config.get("channel_reconcile_chunk", 1000)
+
+# Optional settings for the HTTP client used to talk to the API.
+HTTP_POOL_SIZE = config.get("http_pool_size", 100)
+HTTP_POOL_PER_HOST = config.get("http_pool_per_host", 0)
+HTTP_DNS_CACHE_TTL = config.get("http_dns_cache_ttl", 300)
+HTTP_KEEPALIVE_TIMEOUT = config.get("http_keepalive_timeout", 30)
+HTTP_TIMEOUT = config.get("http_timeout", 300)
+HTTP_CONNECT_TIMEOUT = config.get("http_connect_timeout", 10)
+
+# Where completions come from: "openai" (the engine URLs below),
+# "compatible" (any OpenAI compatible API at BACKEND_BASE_URL) or "mock"
+# (a local mock_server.MockAPI), see create_backend.
+BACKEND = config.get("backend", "openai")
+BACKEND_BASE_URL = config.get("backend_base_url", "http://localhost:8000/v1")
+BACKEND_MODEL = config.get("backend_model", "")
+BACKEND_INSTRUCT_MODEL = config.get("backend_instruct_model", "")
+MOCK_LATENCY = config.get("mock_latency", 0.5)
+MOCK_ERROR_RATE = config.get("mock_error_rate", 0.0)
+MOCK_TEXT = config.get("mock_text", " shirt")
+
+# Serving Prometheus metrics over HTTP, see start_metrics_server. A port of 0
+# turns it off.
+METRICS_HOST = config.get("metrics_host", "127.0.0.1")
+METRICS_PORT = config.get("metrics_port", 0)
+
+# Tracing how long every stage of a reply takes, see Tracer. An empty path
+# means traces are only kept in memory.
+TRACE_PATH = config.get("trace_path", "")
+TRACE_MAX_BYTES = config.get("trace_max_bytes", 5000000)
+TRACE_BACKUPS = config.get("trace_backups", 3)
+TRACE_SLOWEST = config.get("trace_slowest", 20)
+
+# How many of the latest messages are kept in memory per enabled channel.
+TRANSCRIPT_SIZE = config.get("transcript_size", 100)
+
+# How many distinct words the encoder remembers the tokens of.
+ENCODER_CACHE_SIZE = config.get("encoder_cache_size", 65536)
+# How many collected lines the prompt builder remembers the token counts of.
+LINE_CACHE_SIZE = config.get("line_cache_size", 4096)
+
+# Where tokenizing runs: "inline" (on the event loop), "thread" or
+# "process". Texts shorter than TOKENIZER_INLINE_MAX_CHARS always run inline.
+TOKENIZER_EXECUTOR = config.get("tokenizer_executor", "thread")
+TOKENIZER_INLINE_MAX_CHARS = config.get("tokenizer_inline_max_chars", 1000)
+TOKENIZER_WORKERS = config.get("tokenizer_workers", 2)
+
+# Limits for requests to the API, see CompletionScheduler. A limit of 0
+# means no limit.
+COMPLETION_MAX_IN_FLIGHT = config.get("completion_max_in_flight", 8)
+COMPLETION_TOKENS_PER_MINUTE = config.get("completion_tokens_per_minute", 0)
+COMPLETION_MAX_QUEUE = config.get("completion_max_queue", 100)
+
+# Retrying failed API requests, see post_completion and CircuitBreaker.
+API_RETRY_DEADLINE = config.get("api_retry_deadline", 30)
+API_RETRY_BASE_DELAY = config.get("api_retry_base_delay", 0.5)
+API_RETRY_MAX_DELAY = config.get("api_retry_max_delay", 8)
+API_CIRCUIT_FAILURES = config.get("api_circuit_failures", 5)
+API_CIRCUIT_RESET = config.get("api_circuit_reset", 30)
+
+# Streaming generate/instruct output into a message that gets edited.
+STREAM_COMPLETIONS = config.get("stream_completions", False)
+STREAM_EDIT_INTERVAL = config.get("stream_edit_interval", 1.5)
+
+# How many completions are requested for chat replies, the best of which
+# gets sent, see pick_choice.
+COMPLETION_SAMPLES = config.get("completion_samples", 1)
+
+# Sending prompts that arrive together in one request, see
+# CompletionBatcher. A window of 0 turns batching off.
+COMPLETION_BATCH_WINDOW = config.get("completion_batch_window", 0.005)
+COMPLETION_BATCH_MAX = config.get("completion_batch_max", 16)
+
+# Caching completions of low temperature prompts, see ResponseCache.
+RESPONSE_CACHE_MAX_BYTES = config.get("response_cache_max_bytes", 4000000)
+RESPONSE_CACHE_TTL = config.get("response_cache_ttl", 3600)
+RESPONSE_CACHE_MAX_TEMPERATURE = config.get(
+    "response_cache_max_temperature", 0.0
+)
+RESPONSE_CACHE_PATH = config.get("response_cache_path", "")
+API_PRICE_PER_1K_TOKENS = config.get("api_price_per_1k_tokens", 0.02)
+
+# How bursts of messages are handled per mode, see ReplyScheduler.
+REPLY_POLICIES = ("none", "debounce", "supersede")
+
+
+def load_reply_scheduling(overrides):
+    """Returns the default scheduling of every mode updated with the
+    reply_scheduling config entry, which is checked for mistakes."""
+
+    scheduling = {
+        "talk": {"policy": "none", "window": 0.0},
+        "reply": {"policy": "none", "window": 0.0},
+        "random": {"policy": "none", "window": 0.0},
+    }
+    for mode, settings in overrides.items():
+        if mode not in scheduling:
+            raise ValueError(
+                f"Unknown reply_scheduling mode {mode!r}, "
+                f"expected one of {', '.join(scheduling)}."
+            )
+        unknown = set(settings) - {"policy", "window"}
+        if unknown:
+            raise ValueError(
+                f"Unknown reply_scheduling setting(s) for {mode!r}: "
+                f"{', '.join(sorted(unknown))}."
+            )
+        settings = {**scheduling[mode], **settings}
+        if settings["policy"] not in REPLY_POLICIES:
+            raise ValueError(
+                f"Unknown reply_scheduling policy {settings['policy']!r} "
+                f"for {mode!r}, expected one of {', '.join(REPLY_POLICIES)}."
+            )
+        if (
+            not isinstance(settings["window"], (int, float))
+            or settings["window"] < 0
+        ):
+            raise ValueError(
+                f"The reply_scheduling window for {mode!r} has to be a "
+                f"number of seconds, not {settings['window']!r}."
+            )
+        scheduling[mode] = settings
+    return scheduling
+
+
+REPLY_SCHEDULING = load_reply_scheduling(config.get("reply_scheduling", {}))
+
 URL_PATTERN = (
     r"(https?:\/\/(?:www\.|(?!www))"
     r"[a-zA-Z0-9][a-zA-Z0-9-]+[a-zA-Z0-9]\.[^\s]{2,}|"
@@ -32,7 +185,8 @@ URL_PATTERN = (
     r"www\.[a-zA-Z0-9]+\.[^\s]{2,})"
 )
 
-ENCODER = encoder.get_encoder()
+# Loaded in the background by setup_hook, or on first use.
+ENCODER = encoder.LazyEncoder(ENCODER_CACHE_SIZE)
 HEADERS = {
     'Content-Type': 'application/json',
     'Authorization': f'Bearer {API_KEY}',
@@ -81,41 +235,17 @@ help_categories = {k: v.strip() for k, v in matches}
 intents = discord.Intents.default()
 intents.message_content = True
 
-# ###############################################################
-# ### Creating Data Files and Directories if They Don't Exist ###
-# ###############################################################
+# ########################################################
+# ### Loading Channel Settings and Creating Data Files ###
+# ########################################################
 
 if not os.path.exists("./data"):
     os.mkdir("data")
-if not os.path.exists("./data/shirt_talk.txt"):
-    open("data/shirt_talk.txt", "w").close()
-if not os.path.exists("./data/shirt_reply.txt"):
-    open("data/shirt_reply.txt", "w").close()
-if not os.path.exists("./data/shirt_random.txt"):
-    open("data/shirt_random.txt", "w").close()
-if not os.path.exists("./data/uncensored_links.txt"):
-    open("data/uncensored_links.txt", "w").close()
-
-with open("data/shirt_talk.txt") as file:
-    shirt_talk_channels = {
-        int(k.split()[0]): float(k.split()[1])
-        for k in file.read().split('\n')
-        if k
-    }
-with open("data/shirt_reply.txt") as file:
-    shirt_reply_channels = {
-        int(k.split()[0]): float(k.split()[1])
-        for k in file.read().split('\n')
-        if k
-    }
-with open("data/shirt_random.txt") as file:
-    shirt_random_channels = {
-        int(k.split()[0]): tuple(float(x) for x in k.split()[1:])
-        for k in file.read().split('\n')
-        if k
-    }
-with open("data/uncensored_links.txt") as file:
-    uncensored_link_channels = [int(k) for k in file.read().split('\n') if k]
+
+# Settings from before the database existed are in text files, which get
+# migrated when it's created.
+store = channel_store.ChannelStore(DATABASE_PATH, "data")
+channel_settings = channel_store.ChannelSettings.load(store.load())
 
 # #################
 # ### Bot Stuff ###
@@ -125,26 +255,104 @@ with open("data/uncensored_links.txt") as file:
 class ShirtContext(commands.Context):
     """Edited Context that can send a message and apply some filters."""
 
-    async def shirt_send(self, content=None, **kwargs):
+    def shirt_filter(self, content):
         msg = content
-        msg = remove_slurs(msg)
-        if self.channel.id not in uncensored_link_channels:
-            msg = remove_links(msg)
-        await self.send(msg[:2000], **kwargs)
+        filtered = remove_slurs(msg)
+        if filtered != msg:
+            filter_hits["slurs"] += 1
+        msg = filtered
+        if not channel_settings.uncensored_links(self.channel.id):
+            filtered = remove_links(msg)
+            if filtered != msg:
+                filter_hits["links"] += 1
+            msg = filtered
+        return msg[:2000]
+
+    async def shirt_send(self, content=None, **kwargs):
+        with span("filter"):
+            content = self.shirt_filter(content)
+        with span("send"):
+            return await self.send(content, **kwargs)
 
 
 class ShirtBot(commands.Bot):
     """The Shirt Bot class"""
-    
+
+    api_session = None
+    metrics_runner = None
+    settings_task = None
+
     async def get_context(self, message, cls=None):
         return await super().get_context(
             message,
             cls=cls if cls is not None else ShirtContext
         )
-    
+
     async def setup_hook(self):
-        self.queue = asyncio.Queue(maxsize=1)
-        update_data_files.start()
+        self.api_session = create_api_session()
+        await backend.start()
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server()
+        self.loop.run_in_executor(None, ENCODER.load)
+        tokenizer.start()
+        self.loop_lag_task = asyncio.create_task(loop_lag.run())
+        self.command_classifier = CommandClassifier(
+            self.command_prefix,
+            self.all_commands
+        )
+        self.settings_task = asyncio.create_task(settings_writer.run())
+        if CHANNEL_RECONCILE_INTERVAL:
+            reconcile_channels.start()
+
+    async def close(self):
+        await super().close()
+        if self.api_session is not None:
+            await self.api_session.close()
+        tokenizer.close()
+        response_cache.close()
+        await backend.close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        if self.settings_task is not None:
+            self.settings_task.cancel()
+        reconcile_channels.cancel()
+        settings_writer.flush_now()
+        store.close()
+
+
+class CommandClassifier:
+    """Finds out which command a message invokes without making a context.
+
+    The prefixes and command names are compiled once, so classifying a
+    message is a single regex match and a dict lookup. Gives the same answer
+    as Bot.get_context for the default prefix and command resolution."""
+
+    def __init__(self, prefixes, all_commands):
+        # Prefixes are tried in order, just like in Bot.get_context.
+        self.pattern = re.compile(
+            f"(?:{'|'.join(map(re.escape, prefixes))})(\\S*)"
+        )
+        # Maps every command name and alias to the command's name.
+        self.commands = {
+            name: command.name for name, command in all_commands.items()
+        }
+
+    def classify(self, content):
+        """Returns the name of the command the content invokes, or None."""
+
+        match = self.pattern.match(content)
+        if match is None:
+            return None
+        return self.commands.get(match[1])
+
+
+def command_name(message):
+    """Returns the name of the command a message invokes, or None."""
+
+    # Shirt Bot's own messages never invoke commands.
+    if message.author.id == bot.user.id:
+        return None
+    return bot.command_classifier.classify(message.content)
 
 
 class CustomTextChannelConverter(commands.TextChannelConverter):
@@ -184,6 +392,1158 @@ def float_nan_converter(argument):
     return argument
 
 
+def format_stats(stats):
+    """Formats a dict of statistics as a code block."""
+
+    width = max(map(len, stats), default=0)
+    lines = '\n'.join(f"{k:<{width}}  {v}" for k, v in stats.items())
+    return f"```\n{lines}\n```"
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, like a Prometheus
+    histogram."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i in range(bisect.bisect_left(self.buckets, value),
+                       len(self.buckets)):
+            self.counts[i] += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+history_fetch_seconds = Histogram()
+completion_seconds = Histogram()
+filter_hits = collections.Counter()
+
+
+# #######################
+# ### Tracing Replies ###
+# #######################
+
+
+class Trace:
+    """The stages one message went through on its way to a reply."""
+
+    __slots__ = ("id", "kind", "wall_start", "start", "spans")
+
+    def __init__(self, id, kind):
+        self.id = id
+        self.kind = kind
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        # (stage, start, duration), in seconds from the trace's start
+        self.spans = []
+
+    def stages(self):
+        """Returns the total time spent in every stage, in seconds."""
+
+        stages = collections.Counter()
+        for name, _, duration in self.spans:
+            stages[name] += duration
+        return stages
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times the code inside as a stage of the current trace, if there is
+    one. Tasks started inside a trace share it."""
+
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append(
+            (name, start - trace.start, time.perf_counter() - start)
+        )
+
+
+class Tracer:
+    """Collects finished traces, writes them to a rotating JSONL file if
+    there's a path and keeps the slowest ones in memory."""
+
+    def __init__(
+        self,
+        path=TRACE_PATH,
+        max_bytes=TRACE_MAX_BYTES,
+        backups=TRACE_BACKUPS,
+        slowest=TRACE_SLOWEST
+    ):
+        self.size = slowest
+        # Min-heap of (duration, n, trace), so the fastest is dropped first.
+        self.slowest = []
+        self.counter = itertools.count()
+        self.recorded = 0
+        self.logger = None
+        if path:
+            handler = logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=max_bytes,
+                backupCount=backups,
+                encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger = logging.getLogger("shirt_bot.traces")
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    @contextlib.contextmanager
+    def trace(self, kind, id):
+        """Runs the code inside in a new trace, with id (the triggering
+        message's) to correlate its spans."""
+
+        trace = Trace(id, kind)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            self.record(trace, time.perf_counter() - trace.start)
+
+    def record(self, trace, duration):
+        self.recorded += 1
+        if self.logger is not None:
+            self.logger.info(json.dumps({
+                "id": str(trace.id),
+                "kind": trace.kind,
+                "time": round(trace.wall_start, 3),
+                "ms": round(duration * 1000, 2),
+                "spans": [
+                    {
+                        "stage": name,
+                        "start_ms": round(start * 1000, 2),
+                        "ms": round(length * 1000, 2)
+                    }
+                    for name, start, length in trace.spans
+                ]
+            }, separators=(",", ":")))
+        item = (duration, next(self.counter), trace)
+        if len(self.slowest) < self.size:
+            heapq.heappush(self.slowest, item)
+        elif self.size:
+            heapq.heappushpop(self.slowest, item)
+
+    def breakdown(self, top=5):
+        """Returns the mean time per stage of the slowest traces, and the
+        stages of the top slowest ones."""
+
+        traces = sorted(self.slowest, reverse=True)
+        stats = {"traces": self.recorded, "slowest kept": len(traces)}
+        if not traces:
+            return stats
+
+        totals = collections.Counter()
+        for _, _, trace in traces:
+            totals.update(trace.stages())
+        mean_total = sum(duration for duration, _, _ in traces) / len(traces)
+        stats["mean total (ms)"] = round(mean_total * 1000, 1)
+        for name, total in totals.most_common():
+            stats[f"mean {name} (ms)"] = round(total / len(traces) * 1000, 1)
+        stats["mean other (ms)"] = round(
+            (mean_total - sum(totals.values()) / len(traces)) * 1000, 1
+        )
+
+        for duration, _, trace in traces[:top]:
+            stages = " ".join(
+                f"{name}={seconds * 1000:.0f}"
+                for name, seconds in trace.stages().most_common()
+            )
+            stats[f"{trace.kind} {trace.id}"] = (
+                f"{duration * 1000:.0f}ms {stages}"
+            )
+        return stats
+
+
+tracer = Tracer()
+
+
+def traced(function):
+    """Decorator that runs a command in a trace named after how it was
+    invoked."""
+
+    @functools.wraps(function)
+    async def wrapper(ctx, *args, **kwargs):
+        with tracer.trace(ctx.invoked_with, ctx.message.id):
+            return await function(ctx, *args, **kwargs)
+    return wrapper
+
+
+# ###################################
+# ### The Shared API HTTP Session ###
+# ###################################
+
+
+class PoolStats:
+    """Counters describing how the API session's connection pool is used."""
+
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+
+    def trace_config(self):
+        """Returns a trace config that keeps these counters up to date."""
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_end)
+        trace_config.on_connection_create_end.append(self._on_create)
+        trace_config.on_connection_reuseconn.append(self._on_reuse)
+        trace_config.on_connection_queued_start.append(self._on_queued)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def _on_request_end(self, session, context, params):
+        self.in_flight -= 1
+
+    async def _on_create(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_reuse(self, session, context, params):
+        self.connections_reused += 1
+
+    async def _on_queued(self, session, context, params):
+        self.queued += 1
+
+    def as_dict(self):
+        return {
+            "pool_size": HTTP_POOL_SIZE,
+            "pool_per_host": HTTP_POOL_PER_HOST,
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "queued_for_connection": self.queued,
+        }
+
+
+pool_stats = PoolStats()
+
+
+def create_api_session():
+    """Creates the long-lived session used for all API requests.
+
+    Connections are kept alive and reused, so only the first request to the
+    API pays for the TCP and TLS handshakes."""
+
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(
+            total=HTTP_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT
+        ),
+        trace_configs=[pool_stats.trace_config()]
+    )
+
+
+# ###########################
+# ### Completion Backends ###
+# ###########################
+
+
+class EngineBackend:
+    """OpenAI's engine endpoints, which have the engine in their URL."""
+
+    def __init__(self, regular_url, instruct_url):
+        self.regular_url = regular_url
+        self.instruct_url = instruct_url
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def url(self, instruct=False):
+        return self.instruct_url if instruct else self.regular_url
+
+    def prepare(self, datadict, instruct=False):
+        """Adds whatever else the backend needs to a request's body."""
+
+
+class CompatibleBackend(EngineBackend):
+    """Any API that has an OpenAI compatible completions endpoint, which
+    takes the model in the request's body."""
+
+    def __init__(self, base_url, model, instruct_model):
+        url = f"{base_url.rstrip('/')}/completions"
+        super().__init__(url, url)
+        self.model = model
+        self.instruct_model = instruct_model
+
+    def prepare(self, datadict, instruct=False):
+        datadict["model"] = self.instruct_model if instruct else self.model
+
+
+class MockBackend(CompatibleBackend):
+    """A mock_server.MockAPI started in the bot's event loop, for trying
+    out and load testing the bot without spending tokens."""
+
+    def __init__(self, latency=MOCK_LATENCY, error_rate=MOCK_ERROR_RATE,
+                 text=MOCK_TEXT):
+        super().__init__("", "mock", "mock-instruct")
+        self.latency = latency
+        self.error_rate = error_rate
+        self.text = text
+        self.mock = None
+        self.runner = None
+
+    async def start(self):
+        import mock_server
+
+        self.mock = mock_server.MockAPI(
+            latency=self.latency,
+            error_rate=self.error_rate,
+            text=self.text
+        )
+        self.runner, base_url = await mock_server.start(self.mock)
+        self.regular_url = self.instruct_url = f"{base_url}/completions"
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+def create_backend(name=BACKEND):
+    """Creates the completion backend called name in the config."""
+
+    if name == "openai":
+        return EngineBackend(regular_engine_url, instruct_engine_url)
+    if name == "compatible":
+        return CompatibleBackend(
+            BACKEND_BASE_URL,
+            BACKEND_MODEL or REGULAR_ENGINE,
+            BACKEND_INSTRUCT_MODEL or INSTRUCT_ENGINE
+        )
+    if name == "mock":
+        return MockBackend()
+    raise ValueError(f"Unknown completion backend {name!r}.")
+
+
+backend = create_backend()
+
+
+# ###########################
+# ### Running The Encoder ###
+# ###########################
+
+
+class Tokenizer:
+    """Runs encoder methods without blocking the event loop for long.
+
+    Small inputs are tokenized inline, since handing them to an executor
+    costs more than it saves. Bigger ones go to a single thread, which
+    keeps the event loop running between bytecodes, or to worker processes
+    with their own warm encoders, which don't compete for the GIL."""
+
+    def __init__(
+        self,
+        mode=TOKENIZER_EXECUTOR,
+        inline_max_chars=TOKENIZER_INLINE_MAX_CHARS,
+        workers=TOKENIZER_WORKERS
+    ):
+        if mode not in ("inline", "thread", "process"):
+            raise ValueError(f"Unknown tokenizer executor {mode!r}.")
+        self.mode = mode
+        self.inline_max_chars = inline_max_chars
+        self.workers = workers
+        self.pool = None
+        self.calls = collections.Counter()
+        self.seconds = collections.Counter()
+
+    def start(self):
+        if self.mode == "thread":
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="tokenizer"
+            )
+        elif self.mode == "process":
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=encoder.init_worker,
+                initargs=(ENCODER_CACHE_SIZE,)
+            )
+            # Starts the workers, which load their encoders right away.
+            for _ in range(self.workers):
+                self.pool.submit(int)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def run(self, method, *args, size):
+        """Calls ENCODER.method(*args), where size is the input's length."""
+
+        if self.pool is None or size <= self.inline_max_chars:
+            where = "inline"
+            call = functools.partial(getattr(ENCODER, method), *args)
+        elif self.mode == "process":
+            where = "process"
+            call = functools.partial(encoder.call_worker, method, *args)
+        else:
+            where = "thread"
+            call = functools.partial(getattr(ENCODER, method), *args)
+
+        start = time.perf_counter()
+        with span("tokenize"):
+            if where == "inline":
+                result = call()
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.pool,
+                    call
+                )
+        self.calls[where] += 1
+        self.seconds[where] += time.perf_counter() - start
+        return result
+
+    def stats(self):
+        stats = {"executor": self.mode}
+        for where, calls in self.calls.items():
+            stats[f"{where} calls"] = calls
+            stats[f"{where} seconds"] = round(self.seconds[where], 3)
+        return stats
+
+
+tokenizer = Tokenizer()
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from short sleeps, which
+    is how long something kept it from running other tasks."""
+
+    def __init__(self, interval=0.1, window=600):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=window)
+        self.max_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "mean lag (ms)": round(sum(samples) / len(samples) * 1000, 2),
+            "p99 lag (ms)": round(samples[int(len(samples) * 0.99)] * 1000, 2),
+            "recent max lag (ms)": round(samples[-1] * 1000, 2),
+            "all-time max lag (ms)": round(self.max_lag * 1000, 2),
+        }
+
+
+loop_lag = LoopLagMonitor()
+
+
+# ##############################
+# ### Scheduling Completions ###
+# ##############################
+
+
+class CompletionError(Exception):
+    """Raised when a completion couldn't be made."""
+
+
+class CompletionQueueFull(CompletionError):
+    """Raised when a completion request is dropped because too many are
+    waiting already."""
+
+
+class Priority(enum.IntEnum):
+    """Priority of a completion request, lower values go first."""
+
+    COMMAND = 0
+    CONVERSATION = 1
+    AMBIENT = 2
+
+
+class CompletionScheduler:
+    """Limits how many completion requests run at once and how many tokens
+    they use per minute.
+
+    Requests that have to wait are queued by priority, and within a priority
+    guilds take turns, so one busy guild can't starve the others. Once
+    max_queue requests are waiting, the lowest priority one is dropped with
+    CompletionQueueFull, which may be the new request itself."""
+
+    def __init__(
+        self,
+        max_in_flight=COMPLETION_MAX_IN_FLIGHT,
+        tokens_per_minute=COMPLETION_TOKENS_PER_MINUTE,
+        max_queue=COMPLETION_MAX_QUEUE
+    ):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.in_flight = 0
+        # One queue per priority, mapping guild ids to their waiting
+        # requests. A guild moves to the back after each of its turns.
+        self.queues = [collections.OrderedDict() for _ in Priority]
+        self.queued = 0
+        # (start time, tokens) of the requests started in the last minute.
+        self.usage = collections.deque()
+        self.used_tokens = 0
+        self.timer = None
+        self.stats = collections.Counter()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority, guild_id, tokens):
+        """Waits until a request of the given priority and size can run."""
+
+        with span("queue"):
+            await self.acquire(priority, guild_id, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority, guild_id, tokens):
+        if not self.queued and self._can_start(tokens):
+            self._start(tokens)
+            return
+
+        if self.max_queue and self.queued >= self.max_queue:
+            self._shed(priority)
+
+        future = asyncio.get_running_loop().create_future()
+        waiters = self.queues[priority].setdefault(
+            guild_id,
+            collections.deque()
+        )
+        waiters.append((future, tokens))
+        self.queued += 1
+        self.stats["queued"] += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._remove(priority, guild_id, (future, tokens))
+            elif future.exception() is None:
+                # The slot was given just before the request was cancelled.
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _tokens_used(self):
+        cutoff = time.monotonic() - 60
+        while self.usage and self.usage[0][0] <= cutoff:
+            self.used_tokens -= self.usage.popleft()[1]
+        return self.used_tokens
+
+    def _can_start(self, tokens):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        if not self.tokens_per_minute:
+            return True
+        used = self._tokens_used()
+        # A single request bigger than the budget still runs on its own.
+        return not used or used + tokens <= self.tokens_per_minute
+
+    def _start(self, tokens):
+        self.in_flight += 1
+        self.usage.append((time.monotonic(), tokens))
+        self.used_tokens += tokens
+        self.stats["started"] += 1
+
+    def _dispatch(self):
+        """Starts queued requests while there's room for them."""
+
+        for queue in self.queues:
+            while queue:
+                guild_id, waiters = next(iter(queue.items()))
+                future, tokens = waiters[0]
+                # A request can be cancelled before its task takes it out
+                # of the queue, it's dropped without taking a turn.
+                cancelled = future.done()
+                if not cancelled and not self._can_start(tokens):
+                    self._wake_up_later()
+                    return
+                waiters.popleft()
+                if not waiters:
+                    del queue[guild_id]
+                elif not cancelled:
+                    queue.move_to_end(guild_id)
+                self.queued -= 1
+                if not cancelled:
+                    self._start(tokens)
+                    future.set_result(None)
+
+    def _wake_up_later(self):
+        """Dispatches again once the token budget has room, if that's what
+        the queue is waiting for."""
+
+        free_slot = not (
+            self.max_in_flight and self.in_flight >= self.max_in_flight
+        )
+        if self.timer is not None or not free_slot or not self.usage:
+            return
+
+        def wake_up():
+            self.timer = None
+            self._dispatch()
+
+        delay = self.usage[0][0] + 60 - time.monotonic()
+        self.timer = asyncio.get_running_loop().call_later(
+            max(delay, 0),
+            wake_up
+        )
+
+    def _remove(self, priority, guild_id, waiter):
+        waiters = self.queues[priority].get(guild_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del self.queues[priority][guild_id]
+
+    def _shed(self, priority):
+        """Drops the newest waiting request with a lower priority than the
+        new one, or the new one if there's none."""
+
+        for lower in reversed(Priority):
+            if lower <= priority:
+                break
+            queue = self.queues[lower]
+            while queue:
+                guild_id = next(reversed(queue))
+                future, tokens = queue[guild_id].pop()
+                if not queue[guild_id]:
+                    del queue[guild_id]
+                self.queued -= 1
+                if future.done():
+                    # Cancelled already, dropping it may have made room.
+                    if self.queued < self.max_queue:
+                        return
+                    continue
+                self.stats["shed"] += 1
+                future.set_exception(CompletionQueueFull())
+                return
+        self.stats["shed"] += 1
+        raise CompletionQueueFull()
+
+    def as_dict(self):
+        stats = {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "tokens_last_minute": self._tokens_used(),
+            "tokens_per_minute": self.tokens_per_minute,
+        }
+        for priority in Priority:
+            stats[f"queued ({priority.name.lower()})"] = sum(
+                map(len, self.queues[priority].values())
+            )
+        stats.update(self.stats)
+        return stats
+
+
+completion_scheduler = CompletionScheduler()
+
+
+# #############################
+# ### Retrying API Requests ###
+# #############################
+
+
+class APIError(CompletionError):
+    """Raised when the API keeps failing or rejects a request."""
+
+    def __init__(self, status, message):
+        super().__init__(
+            f"API request failed with status {status}: {message}"
+            if status is not None else f"API request failed: {message}"
+        )
+        self.status = status
+
+
+class CircuitOpen(CompletionError):
+    """Raised instead of sending a request while the API is considered
+    down."""
+
+
+class CircuitBreaker:
+    """Stops sending requests to the API for a while after it failed too
+    many times in a row, so an outage doesn't turn into a retry storm.
+
+    After reset_timeout seconds a single trial request is let through, and
+    its outcome decides whether requests resume or the wait starts over."""
+
+    def __init__(
+        self,
+        failure_threshold=API_CIRCUIT_FAILURES,
+        reset_timeout=API_CIRCUIT_RESET
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def check(self):
+        """Raises CircuitOpen if a request can't be sent right now. Returns
+        True if the request is the trial, which has to be ended with
+        success, failure or release."""
+
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial):
+            raise CircuitOpen("The API is failing, not sending requests.")
+        if state == "half-open":
+            self.trial = True
+            return True
+        return False
+
+    def release(self):
+        """Lets another trial request through if the trial ended without
+        telling whether the API works, e.g. it was cancelled or rate
+        limited."""
+
+        self.trial = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial:
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+
+circuit_breaker = CircuitBreaker()
+api_stats = collections.Counter()
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def retry_after(headers):
+    """Returns how many seconds the API asks to wait before retrying, going
+    by the Retry-After and rate limit reset headers, or None."""
+
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            with contextlib.suppress(TypeError, ValueError):
+                date = email.utils.parsedate_to_datetime(value)
+                return max(date.timestamp() - time.time(), 0.0)
+
+    # e.g. "x-ratelimit-reset-requests: 6m0s"
+    delays = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            reset = headers.get(f"x-ratelimit-reset-{kind}", "")
+            delays.append(sum(
+                float(amount) * DURATION_UNITS[unit]
+                for amount, unit in DURATION_PATTERN.findall(reset)
+            ))
+    return max(delays) if delays else None
+
+
+async def read_stream(response, on_text, stop=()):
+    """Reads a streamed completion's server-sent events and returns its
+    text, awaiting on_text with the text so far whenever more arrives.
+
+    Reading stops early once a stop sequence shows up, which closes the
+    connection instead of waiting for the API to notice it."""
+
+    text = ""
+    async for line in response.content:
+        if not line.startswith(b"data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            break
+        choices = json.loads(payload).get("choices")
+        if not choices or not choices[0].get("text"):
+            continue
+        text += choices[0]["text"]
+        stops = [text.find(s) for s in stop if s in text]
+        if stops:
+            api_stats["stopped early"] += 1
+            return text[:min(stops)]
+        await on_text(text)
+    return text
+
+
+async def post_completion(
+    url,
+    data,
+    *,
+    deadline=API_RETRY_DEADLINE,
+    on_text=None,
+    stop=()
+):
+    """Posts a completion request and returns the decoded response.
+
+    Rate limits (429), server errors (5xx) and connection errors are retried
+    with exponential backoff and full jitter, or after the delay the API
+    asks for, as long as that's within deadline seconds. Other errors are
+    raised right away as APIError. Server and connection errors count
+    towards opening circuit_breaker.
+
+    If on_text is given the request must be a streaming one, and its text
+    is read with read_stream. Once text started arriving, errors are no
+    longer retried."""
+
+    give_up_at = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        trial = circuit_breaker.check()
+        delay = None
+        streaming = False
+        try:
+            async with bot.api_session.post(url, data=data) as response:
+                status = response.status
+                if status == 200 and on_text is not None:
+                    streaming = True
+                    response_text = await read_stream(response, on_text, stop)
+                else:
+                    response_text = await response.text()
+                if status == 429:
+                    delay = retry_after(response.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            api_stats["connection errors"] += 1
+            circuit_breaker.failure()
+            error = APIError(None, repr(e))
+            if streaming:
+                raise error from e
+        else:
+            api_stats[f"status {status}"] += 1
+            if status == 200:
+                circuit_breaker.success()
+                if streaming:
+                    return {"choices": [{"text": response_text}]}
+                return json.loads(response_text)
+            error = APIError(status, response_text[:200])
+            if status >= 500:
+                circuit_breaker.failure()
+            elif status != 429:
+                # The API is up, it just doesn't like the request.
+                circuit_breaker.success()
+                raise error
+        finally:
+            # Cancellation, errors from on_text and rate limits neither
+            # close nor reopen the circuit.
+            if trial:
+                circuit_breaker.release()
+
+        if delay is None:
+            delay = random.uniform(
+                0,
+                min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** attempt)
+            )
+        if time.monotonic() + delay > give_up_at:
+            api_stats["gave up"] += 1
+            raise error
+        api_stats["retries"] += 1
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+def api_stats_dict():
+    return {
+        "circuit": circuit_breaker.state,
+        "circuit opened": circuit_breaker.times_opened,
+        **dict(sorted(api_stats.items())),
+    }
+
+
+# ##########################
+# ### Batching Responses ###
+# ##########################
+
+
+class CompletionBatcher:
+    """Sends prompts that arrive within window seconds of each other in one
+    request, as the completions endpoint takes a list of prompts.
+
+    Only prompts for the same URL with the same other parameters are
+    batched. A batch is sent early once it has max_size prompts, and the
+    choices of the response are handed back by their index."""
+
+    def __init__(
+        self,
+        window=COMPLETION_BATCH_WINDOW,
+        max_size=COMPLETION_BATCH_MAX
+    ):
+        self.window = window
+        self.max_size = max_size
+        # (url, parameters) -> [(prompt, future), ...]
+        self.pending = {}
+        self.timers = {}
+        # The event loop only keeps weak references to tasks.
+        self.tasks = set()
+        self.requests = 0
+        self.prompts = 0
+
+    async def submit(self, url, datadict):
+        """Sends datadict's prompt with the next batch and returns a
+        response containing just its choices."""
+
+        params = {k: v for k, v in datadict.items() if k != "prompt"}
+        group = (url, json.dumps(params, sort_keys=True))
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(group, [])
+        batch.append((datadict["prompt"], future))
+        if len(batch) >= self.max_size:
+            self._flush(group)
+        elif len(batch) == 1:
+            self.timers[group] = asyncio.get_running_loop().call_later(
+                self.window,
+                self._flush,
+                group
+            )
+        return await future
+
+    def _flush(self, group):
+        timer = self.timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(group, None)
+        if batch:
+            task = asyncio.create_task(self._send(group, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, group, batch):
+        url, params = group
+        datadict = json.loads(params)
+        datadict["prompt"] = [prompt for prompt, _ in batch]
+        n = datadict.get("n", 1)
+        self.requests += 1
+        self.prompts += len(batch)
+        try:
+            response = await post_completion(
+                url,
+                json.dumps(datadict, separators=(",", ":"))
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        choices = [[] for _ in batch]
+        for choice in response["choices"]:
+            choices[choice["index"] // n].append(choice)
+        for (_, future), prompt_choices in zip(batch, choices):
+            if not future.done():
+                future.set_result({"choices": prompt_choices})
+
+    def as_dict(self):
+        return {
+            "batch_requests": self.requests,
+            "batch_prompts": self.prompts,
+            "prompts_per_batch": (
+                round(self.prompts / self.requests, 2) if self.requests
+                else "n/a"
+            ),
+        }
+
+
+completion_batcher = CompletionBatcher()
+
+
+# #########################
+# ### Caching Responses ###
+# #########################
+
+
+class ResponseCache:
+    """Remembers completions of prompts sent with a low enough temperature,
+    so sending the same prompt again doesn't cost anything.
+
+    Entries expire after ttl seconds. The least recently used ones are
+    dropped once the cached text takes up more than max_bytes, and with a
+    path, entries are also kept in an SQLite database so they survive
+    restarts."""
+
+    # Rough size of an entry besides its text, for the memory limit.
+    ENTRY_OVERHEAD = 200
+
+    def __init__(
+        self,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl=RESPONSE_CACHE_TTL,
+        max_temperature=RESPONSE_CACHE_MAX_TEMPERATURE,
+        path=RESPONSE_CACHE_PATH
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, isolation_level=None)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, text TEXT, tokens INTEGER, "
+                "expires REAL)"
+            )
+            self.db.execute(
+                "DELETE FROM responses WHERE expires < ?", (time.time(),)
+            )
+
+    def applies(self, temperature):
+        return (
+            (self.max_bytes > 0 or self.db is not None)
+            and temperature <= self.max_temperature
+        )
+
+    @staticmethod
+    def key(url, model, prompt, max_tokens, temperature, stop):
+        # Backends that send every model to one URL name it in the request
+        # instead, so both are part of the key.
+        # Whitespace differences don't change what the prompt says.
+        prompt = "\n".join(
+            " ".join(line.split()) for line in prompt.strip().split("\n")
+        )
+        return hashlib.sha256(json.dumps(
+            [url, model, prompt, max_tokens, temperature, stop]
+        ).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached completion for key, or None."""
+
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            entry = self.db.execute(
+                "SELECT expires, text, tokens FROM responses WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is not None and entry[0] < time.time():
+            if self.entries.pop(key, None) is not None:
+                self.bytes -= len(entry[1]) + self.ENTRY_OVERHEAD
+            if self.db is not None:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        # With max_bytes 0 only the database keeps entries.
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.hits += 1
+        self.tokens_saved += entry[2]
+        return entry[1]
+
+    def put(self, key, text, tokens):
+        """Caches text as the completion for key, which used tokens."""
+
+        entry = (time.time() + self.ttl, text, tokens)
+        self._remember(key, entry)
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, text, tokens, entry[0])
+            )
+
+    def _remember(self, key, entry):
+        if self.max_bytes <= 0:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[1]) + self.ENTRY_OVERHEAD
+        self.entries[key] = entry
+        self.bytes += len(entry[1]) + self.ENTRY_OVERHEAD
+        while self.bytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= len(old[1]) + self.ENTRY_OVERHEAD
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit rate": f"{self.hits / lookups:.1%}" if lookups else "n/a",
+            "tokens saved": self.tokens_saved,
+            "dollars saved": round(
+                self.tokens_saved / 1000 * API_PRICE_PER_1K_TOKENS, 4
+            ),
+        }
+
+
+response_cache = ResponseCache()
+
+
 # #########################################################
 # ### Stuff For Collecting Messages and Sending Prompts ###
 # #########################################################
@@ -195,32 +1555,270 @@ class MessageCollectionType(enum.Enum):
     SHIRT_REPLY = 2
 
 
+# How many messages are looked at and how many are collected at most.
+HISTORY_LIMIT = 50
+COLLECT_LIMIT = 15
+
+
+class TranscriptEntry:
+    """The parts of a message the message collector needs."""
+
+    __slots__ = ("id", "author", "content", "type", "command")
+
+    def __init__(self, message, command):
+        self.id = message.id
+        self.author = (
+            message.author.name if message.author != bot.user else NAME
+        )
+        self.content = message.content
+        self.type = message.type
+        # The name of the command the message invokes, if it invokes one.
+        self.command = command
+
+
+def make_entry(message):
+    """Makes a transcript entry from a message."""
+
+    return TranscriptEntry(message, command_name(message))
+
+
+class Transcript:
+    """Rolling copy of the latest messages of a channel, oldest first.
+
+    A transcript is kept up to date by the message events. It is cold until
+    it's been backfilled from the channel's history, which happens the first
+    time messages are collected from it and again after it's invalidated."""
+
+    def __init__(self, size=TRANSCRIPT_SIZE):
+        self.entries = collections.deque(maxlen=size)
+        self.warm = False
+        # Whether the entries go back to the very first message.
+        self.complete = False
+        self.lock = asyncio.Lock()
+        self._deleted = set()
+
+    def add(self, entry):
+        entries = self.entries
+        if entries and entries[-1].id >= entry.id:
+            # Events don't always arrive in order.
+            self._replace([*entries, entry])
+            return
+        if len(entries) == entries.maxlen:
+            self.complete = False
+        entries.append(entry)
+
+    def _replace(self, entries):
+        merged = {x.id: x for x in entries}
+        for message_id in self._deleted:
+            merged.pop(message_id, None)
+        merged = sorted(merged.values(), key=lambda x: x.id)
+        if len(merged) > self.entries.maxlen:
+            self.complete = False
+        self.entries.clear()
+        self.entries.extend(merged[-self.entries.maxlen:])
+
+    def update(self, entry):
+        for i, x in enumerate(self.entries):
+            if x.id == entry.id:
+                self.entries[i] = entry
+                return
+
+    def remove(self, message_id):
+        if self.lock.locked():
+            self._deleted.add(message_id)
+        for x in self.entries:
+            if x.id == message_id:
+                self.entries.remove(x)
+                return
+
+    def __contains__(self, message_id):
+        return any(x.id == message_id for x in self.entries)
+
+    def invalidate(self):
+        self.entries.clear()
+        self.warm = False
+        self.complete = False
+
+    def before(self, message_id=None):
+        """Returns the entries older than a message, newest first."""
+
+        return [
+            x for x in reversed(self.entries)
+            if message_id is None or x.id < message_id
+        ]
+
+    async def backfill(self, channel):
+        """Fills the transcript from the channel's history."""
+
+        async with self.lock:
+            if self.warm:
+                return
+            size = self.entries.maxlen
+            fetched = [
+                make_entry(x)
+                async for x in channel.history(limit=size)
+            ]
+            # Keep whatever the events added while the history was fetched.
+            self.complete = len(fetched) < size
+            self._replace([*reversed(fetched), *self.entries])
+            self._deleted.clear()
+            self.warm = True
+
+
+transcripts = {}
+
+
+def is_shirt_channel(channel_id):
+    """Returns True if any automatic reply mode is on in a channel."""
+
+    record = channel_settings.get(channel_id)
+    return record is not None and (
+        record.talk is not None or
+        record.reply is not None or
+        record.random_randomness is not None
+    )
+
+
+def record_message(message):
+    """Adds a new message to its channel's transcript."""
+
+    channel_id = message.channel.id
+    if not is_shirt_channel(channel_id):
+        # Drop the transcript so it isn't stale if the channel's turned on.
+        transcripts.pop(channel_id, None)
+        return
+    if channel_id not in transcripts:
+        transcripts[channel_id] = Transcript()
+    transcripts[channel_id].add(make_entry(message))
+
+
+def record_edit(message):
+    """Updates an edited message in its channel's transcript."""
+
+    transcript = transcripts.get(message.channel.id)
+    if transcript is not None and message.id in transcript:
+        transcript.update(make_entry(message))
+
+
+def record_deletes(channel_id, message_ids):
+    """Removes deleted messages from their channel's transcript."""
+
+    transcript = transcripts.get(channel_id)
+    if transcript is not None:
+        for message_id in message_ids:
+            transcript.remove(message_id)
+
+
+async def iter_history(channel, before=None):
+    """Yields transcript entries of the messages before a message, newest
+    first, like channel.history(limit=HISTORY_LIMIT) would.
+
+    Enabled channels are served from their transcript, everything else
+    (and anything older than the transcript) comes from the API."""
+
+    transcript = None
+    if is_shirt_channel(channel.id):
+        transcript = transcripts.setdefault(channel.id, Transcript())
+        if not transcript.warm:
+            await transcript.backfill(channel)
+
+    remaining = HISTORY_LIMIT
+    if transcript is not None:
+        entries = transcript.before(before.id if before else None)
+        for x in entries[:remaining]:
+            yield x
+        remaining -= len(entries)
+        if remaining <= 0 or transcript.complete:
+            return
+        if entries:
+            before = discord.Object(entries[-1].id)
+
+    async for x in channel.history(limit=remaining, before=before):
+        yield make_entry(x)
+
+
 async def collect_messages(channel, *, mode, before=None):
     """Collects messages from a channel for Shirt Bot"""
 
     lst = []
-    async for x in channel.history(limit=50, before=before):
-        context = await bot.get_context(x)
-        if context.valid and context.command.name == "reset":
-            break
+    with history_fetch_seconds.time(), span("history"):
+        async for x in iter_history(channel, before):
+            if x.command == "reset":
+                break
+
+            if x.command is None and x.type != discord.MessageType.default:
+                if (
+                    x.content.startswith("# ") and
+                    mode == MessageCollectionType.SHIRT_TALK
+                ):
+                    lst.append(f"{x.author}: {x.content[1:].lstrip()}")
+                elif (
+                    mode == MessageCollectionType.TRIGGER_OR_SHIRT_RANDOM or
+                    (not x.content.startswith("$ ") and x.content != "#")
+                ):
+                    lst.append(f"{x.author}: {x.content}")
+
+            if len(lst) >= COLLECT_LIMIT:
+                break
+    lst.reverse()
+    return lst
 
-        if not context.valid and x.type != discord.MessageType.default:
-            author = x.author.name if x.author != bot.user else NAME
-            if (
-                x.content.startswith("# ") and
-                mode == MessageCollectionType.SHIRT_TALK
-            ):
-                lst.append(f"{author}: {x.content[1:].lstrip()}")
-            elif (
-                mode == MessageCollectionType.TRIGGER_OR_SHIRT_RANDOM or
-                (not x.content.startswith("$ ") and x.content != "#")
-            ):
-                lst.append(f"{author}: {x.content}")
 
-        if len(lst) >= 15:
+line_token_counts = encoder.LRUCache(LINE_CACHE_SIZE)
+
+
+def count_line_tokens(line):
+    """Returns the number of tokens in a collected line, with caching."""
+
+    count = line_token_counts.get(line)
+    if count is None:
+        count = ENCODER.count_tokens(line)
+        line_token_counts[line] = count
+    return count
+
+
+async def build_prompt(lines, cue, max_tokens):
+    """Joins collected lines and the cue for Shirt Bot's reply into a prompt
+    that leaves room for max_tokens tokens of completion.
+
+    Lines are added from the newest to the oldest until the token budget is
+    used up, so it's the oldest lines that get left out. Returns the prompt
+    and its token count, so send_prompt doesn't have to encode it again. The
+    count is None if not even the cue fits.
+
+    A newline between lines is always a word of its own, so the count is
+    just the sum of the lines' counts plus one per newline."""
+
+    # Lines the cache doesn't know are counted in one go, with the cue.
+    missing = [line for line in lines if line not in line_token_counts]
+    cue_tokens, *counts = await tokenizer.run(
+        "count_tokens_many",
+        [cue, *missing],
+        size=len(cue) + sum(map(len, missing))
+    )
+    for line, count in zip(missing, counts):
+        line_token_counts[line] = count
+
+    budget = TOKEN_LIMIT - max_tokens - cue_tokens
+    # The cue always comes after a newline.
+    if budget < 1:
+        return '\n'.join([*lines, cue]), None
+
+    kept = []
+    for line in reversed(lines):
+        # Every line is followed by a newline.
+        cost = count_line_tokens(line) + 1
+        if cost > budget:
             break
-    lst.reverse()
-    return lst
+        budget -= cost
+        kept.append(line)
+    kept.reverse()
+
+    prompt = '\n'.join(kept)
+    prompt_tokens = TOKEN_LIMIT - max_tokens - budget
+    if not kept:
+        prompt_tokens += 1
+    return f"{prompt}\n{cue}", prompt_tokens
 
 
 async def send_prompt(
@@ -230,143 +1828,708 @@ async def send_prompt(
     *,
     decrease_max=False,
     first_line=True,
-    instruct=False
+    instruct=False,
+    prompt_tokens=None,
+    priority=Priority.COMMAND,
+    guild_id=None,
+    on_text=None,
+    samples=None
 ):
-    """Sends prompt to the OpenAI API."""
+    """Sends prompt to the completion backend.
+
+    prompt_tokens is the prompt's token count if it's already known, e.g.
+    from build_prompt. If the prompt is too long, its start is cut off so
+    the newest part of it is kept, unless decrease_max is set, in which case
+    max_tokens is lowered instead.
+
+    The request waits for its turn in completion_scheduler, where priority
+    and guild_id decide its place.
 
-    tokens = ENCODER.encode(prompt)
-    if len(tokens) > TOKEN_LIMIT-max_tokens and not decrease_max:
-        tokens = tokens[:TOKEN_LIMIT-max_tokens]
-    elif len(tokens) > TOKEN_LIMIT-max_tokens and decrease_max:
-        max_tokens = TOKEN_LIMIT-len(tokens)
-    prompt = ENCODER.decode(tokens)
+    If on_text is given the completion is streamed, and on_text is awaited
+    with the text so far whenever more of it arrives.
+
+    samples completions are requested and the best one is picked with
+    pick_choice. It defaults to COMPLETION_SAMPLES for first line
+    completions and to 1 otherwise, and streamed completions only get one.
+
+    Completions at low temperatures are looked up in and stored in
+    response_cache. Other than streamed ones, requests are sent through
+    completion_batcher."""
+
+    if decrease_max:
+        if prompt_tokens is None:
+            prompt_tokens = await tokenizer.run(
+                "count_tokens",
+                prompt,
+                size=len(prompt)
+            )
+        if prompt_tokens > TOKEN_LIMIT-max_tokens:
+            max_tokens = TOKEN_LIMIT-prompt_tokens
+    elif prompt_tokens is None or prompt_tokens > TOKEN_LIMIT-max_tokens:
+        prompt = await tokenizer.run(
+            "truncate",
+            prompt,
+            TOKEN_LIMIT-max_tokens,
+            "left",
+            size=len(prompt)
+        )
+
+    if samples is None:
+        samples = COMPLETION_SAMPLES if first_line else 1
+    if on_text is not None:
+        samples = 1
 
     datadict = {
         "prompt": prompt,
         "max_tokens": max_tokens,
         "temperature": temperature,
-        "n": 1,
-        "stream": False,
+        "n": samples,
+        "stream": on_text is not None,
         "logprobs": None,
         "presence_penalty": 0.5,
         "frequency_penalty": 0.1
     }
     if first_line:
         datadict["stop"] = ["\n"]
-    data = json.dumps(datadict, separators=(",", ":"))
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            regular_engine_url if not instruct else instruct_engine_url,
-            headers=HEADERS,
-            data=data
-        ) as response:
-            response_text = await response.text()
-
-    result = json.loads(response_text)["choices"][0]["text"]
+
+    backend.prepare(datadict, instruct)
+    url = backend.url(instruct)
+    cache_key = None
+    if response_cache.applies(temperature):
+        cache_key = response_cache.key(
+            url,
+            datadict.get("model"),
+            prompt,
+            max_tokens,
+            temperature,
+            datadict.get("stop")
+        )
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    # If the prompt was truncated its size isn't known, but it's at most
+    # what's left after max_tokens.
+    if prompt_tokens is None or prompt_tokens > TOKEN_LIMIT-max_tokens:
+        prompt_tokens = TOKEN_LIMIT-max_tokens
+    with completion_seconds.time():
+        async with completion_scheduler.slot(
+            priority,
+            guild_id,
+            prompt_tokens+max_tokens*samples
+        ):
+            with span("api"):
+                if on_text is None and completion_batcher.window > 0:
+                    response = await completion_batcher.submit(url, datadict)
+                else:
+                    response = await post_completion(
+                        url,
+                        json.dumps(datadict, separators=(",", ":")),
+                        on_text=on_text,
+                        stop=datadict.get("stop", ())
+                    )
+
+    result = pick_choice(response["choices"], prompt)
+    if cache_key is not None:
+        # Streamed responses don't report their usage.
+        tokens = response.get("usage", {}).get("total_tokens")
+        if tokens is None:
+            tokens = prompt_tokens + await tokenizer.run(
+                "count_tokens",
+                result,
+                size=len(result)
+            )
+        response_cache.put(cache_key, result, tokens)
     return result
 
 
-# #####################################
-# ### Tasks For Updating Data Files ###
-# #####################################
+def rank_choice(choice, recent):
+    """Returns a sort key for a completion choice, higher is better."""
 
-@tasks.loop()
-async def update_data_files():
-    """Updates data files."""
+    text = choice["text"].strip()
+    return (
+        bool(text),
+        remove_slurs(text) == text,
+        remove_links(text) == text,
+        text.lower() not in recent,
+        # Choices that ran out of tokens got cut off.
+        choice.get("finish_reason") != "length",
+    )
 
-    operation, channel_id, randomness, chance = await bot.queue.get()
 
-    await clean_unused_channels()
+def pick_choice(choices, prompt):
+    """Returns the text of the best of the API's choices for prompt.
 
-    opdict = {
-        "SET_SHIRT_TALK": (
-            randomness,
-            "shirt_talk",
-            shirt_talk_channels
-        ),
-        "SET_SHIRT_REPLY": (
+    Empty choices, ones the filters would change, ones that repeat one of
+    the prompt's last few messages and ones that got cut off are avoided,
+    otherwise the API's order is kept."""
+
+    if len(choices) <= 1:
+        return choices[0]["text"]
+    # The last lines before the cue are "author: message".
+    recent = {
+        line.partition(": ")[2].strip().lower()
+        for line in prompt.split("\n")[-4:-1]
+    }
+    best = max(choices, key=lambda choice: rank_choice(choice, recent))
+    if best is not choices[0]:
+        api_stats["samples reranked"] += 1
+    return best["text"]
+
+
+class ProgressiveReply:
+    """A reply to a streamed completion that's posted once its first line
+    is complete and then edited as more text arrives.
+
+    Edits happen at most once every interval seconds and never wait on each
+    other, so the stream is read at full speed and Discord's edit rate
+    limit isn't hit. The text is filtered like with shirt_send."""
+
+    def __init__(self, ctx, prefix="", interval=STREAM_EDIT_INTERVAL):
+        self.ctx = ctx
+        self.prefix = prefix
+        self.interval = interval
+        self.text = ""
+        self.message = None
+        self.shown = None
+        self.last_edit = 0.0
+        self.editing = None
+        # Set once posting the reply failed, finish tries again.
+        self.failed = False
+
+    async def update(self, text):
+        """Takes the completion's text so far."""
+
+        self.text = text
+        if self.failed:
+            return
+        if self.message is None:
+            first_line, newline, _ = (self.prefix + text).partition("\n")
+            if newline and first_line.strip():
+                self.shown = self.ctx.shirt_filter(first_line)
+                self.last_edit = time.monotonic()
+                # Like _edit, a failed send mustn't stop the completion.
+                try:
+                    self.message = await self.ctx.send(
+                        self.shown,
+                        reference=self.ctx.message
+                    )
+                except discord.HTTPException:
+                    self.failed = True
+            return
+        if (
+            (self.editing is None or self.editing.done())
+            and time.monotonic() - self.last_edit >= self.interval
+        ):
+            self.editing = asyncio.create_task(self._edit(self.prefix + text))
+
+    async def _edit(self, content):
+        content = self.ctx.shirt_filter(content)
+        if content == self.shown:
+            return
+        self.last_edit = time.monotonic()
+        with contextlib.suppress(discord.HTTPException):
+            await self.message.edit(content=content)
+            self.shown = content
+
+    async def finish(self, text=None):
+        """Shows the final text, text so far if not given."""
+
+        if text is not None:
+            self.text = text
+        if self.message is None:
+            with contextlib.suppress(discord.HTTPException):
+                await self.ctx.shirt_send(
+                    self.prefix + self.text,
+                    reference=self.ctx.message
+                )
+            return
+        if self.editing is not None:
+            await self.editing
+        await self._edit(self.prefix + self.text)
+
+
+# ########################
+# ### Routing Messages ###
+# ########################
+
+
+class Route(enum.Enum):
+    """Where the message dispatcher sends a message."""
+
+    SHIRT_TALK = "talk"
+    SHIRT_REPLY = "reply"
+    SHIRT_RANDOM = "random"
+    IGNORE = "ignore"
+
+
+# How many messages went to every route, and why messages got ignored.
+route_stats = collections.Counter()
+ignore_stats = collections.Counter()
+
+
+def ignore_message(reason):
+    route_stats[Route.IGNORE] += 1
+    ignore_stats[reason] += 1
+    return Route.IGNORE
+
+
+def route_message(message):
+    """Decides which automatic reply mode handles a message.
+
+    The checks follow the precedence from the help: commands, then shirt
+    talk, then shirt reply, then shirt random. Messages in channels without
+    any of the modes on are dropped first, as that's most of them."""
+
+    channel_id = message.channel.id
+
+    if not is_shirt_channel(channel_id):
+        return ignore_message("channel")
+    if command_name(message) is not None:
+        return ignore_message("command")
+    if message.author.bot:
+        return ignore_message("bot")
+    if message.type != discord.MessageType.default:
+        return ignore_message("system")
+
+    record = channel_settings.get(channel_id)
+    if record.talk is not None:
+        if message.content.startswith("# "):
+            return ignore_message("non-triggering")
+        route = Route.SHIRT_TALK
+    elif record.reply is not None and replies_to_bot(message):
+        route = Route.SHIRT_REPLY
+    elif record.random_randomness is not None:
+        route = Route.SHIRT_RANDOM
+    else:
+        return ignore_message("channel")
+
+    route_stats[route] += 1
+    return route
+
+
+def replies_to_bot(message):
+    """Returns True if a message replies to one of Shirt Bot's messages."""
+
+    ref_message = message.reference.resolved if message.reference else None
+    return ref_message is not None and (
+        not isinstance(ref_message, discord.DeletedReferencedMessage) and
+        ref_message.author == bot.user
+    )
+
+
+def routing_stats():
+    stats = {route.value: route_stats[route] for route in Route}
+    stats.update(
+        (f"ignored ({reason})", count)
+        for reason, count in ignore_stats.most_common()
+    )
+    return stats
+
+
+# ##########################
+# ### Scheduling Replies ###
+# ##########################
+
+
+class ReplyScheduler:
+    """Makes sure a burst of messages in a channel gets one reply instead of
+    one for every message.
+
+    Every mode has a policy and a window in seconds:
+      none       every message gets its own reply right away
+      debounce   the reply is generated once no new message has come in for
+                 the window, a reply that's already being generated still
+                 gets sent
+      supersede  like debounce, but a new message also cancels a reply
+                 that's already being generated"""
+
+    def __init__(self, scheduling=REPLY_SCHEDULING):
+        self.scheduling = scheduling
+        # The latest reply task of every channel, and whether it's past the
+        # window and generating.
+        self.tasks = {}
+        self.generating = set()
+        self.stats = collections.Counter()
+
+    async def run(self, channel_id, route, generate):
+        """Runs generate() for a message in a channel and returns its result,
+        or None if a newer message took its place."""
+
+        settings = self.scheduling[route.value]
+        self.stats["scheduled"] += 1
+        if settings["policy"] == "none":
+            return await generate()
+
+        previous = self.tasks.get(channel_id)
+        if previous is not None and not previous.done():
+            if previous not in self.generating:
+                previous.cancel()
+                self.stats["debounced"] += 1
+            elif settings["policy"] == "supersede":
+                previous.cancel()
+                self.stats["superseded"] += 1
+
+        task = asyncio.create_task(self._run(settings["window"], generate))
+        self.tasks[channel_id] = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self.tasks.get(channel_id) is task:
+                del self.tasks[channel_id]
+
+        if task.cancelled():
+            return None
+        return task.result()
+
+    async def _run(self, window, generate):
+        with span("debounce"):
+            await asyncio.sleep(window)
+        task = asyncio.current_task()
+        self.generating.add(task)
+        try:
+            return await generate()
+        finally:
+            self.generating.discard(task)
+
+
+reply_scheduler = ReplyScheduler()
+
+
+# ###################################
+# ### Writing The Channel Settings ###
+# ###################################
+
+# Which setting every operation changes, changes to the same setting of a
+# channel replace each other.
+OPERATION_SETTINGS = {
+    "SET_SHIRT_TALK": "talk",
+    "UNSET_SHIRT_TALK": "talk",
+    "SET_SHIRT_REPLY": "reply",
+    "UNSET_SHIRT_REPLY": "reply",
+    "SET_SHIRT_RANDOM": "random",
+    "UNSET_SHIRT_RANDOM": "random",
+    "UNCENSOR_LINKS": "links",
+    "CENSOR_LINKS": "links",
+}
+
+
+class SettingsWriter:
+    """Applies channel settings changes in memory right away and writes them
+    to the store in batches.
+
+    Only the latest change to each setting of a channel is kept until it's
+    written. Changes are written every interval seconds, or as soon as
+    max_batch of them are waiting, each batch in one transaction."""
+
+    def __init__(self, interval=DATA_FLUSH_INTERVAL,
+                 max_batch=DATA_MAX_BATCH):
+        self.interval = interval
+        self.max_batch = max_batch
+        # (channel id, setting) -> the arguments of ChannelStore.apply
+        self.pending = {}
+        # Channels whose settings are all to be deleted.
+        self.removed = set()
+        self.full = asyncio.Event()
+        self.stats = collections.Counter()
+
+    def submit(self, operation, channel_id, randomness=None, chance=None,
+               guild_id=None):
+        channel_settings.apply(
+            operation,
+            channel_id,
             randomness,
-            "shirt_reply",
-            shirt_reply_channels
-        ),
-        "SET_SHIRT_RANDOM": (
+            chance,
+            guild_id
+        )
+        key = (channel_id, OPERATION_SETTINGS[operation])
+        if self.pending.pop(key, None) is not None:
+            self.stats["folded"] += 1
+        self.pending[key] = (
+            operation,
+            channel_id,
             randomness,
             chance,
-            "shirt_random",
-            shirt_random_channels
-        ),
-        "UNSET_SHIRT_TALK": (
-            "shirt_talk",
-            shirt_talk_channels
-        ),
-        "UNSET_SHIRT_REPLY": (
-            "shirt_reply",
-            shirt_reply_channels
-        ),
-        "UNSET_SHIRT_RANDOM": (
-            "shirt_random",
-            shirt_random_channels
-        ),
-        "UNCENSOR_LINKS": (
-            "uncensored_links",
-            uncensored_link_channels
-        ),
-        "CENSOR_LINKS": (
-            "uncensored_links",
-            uncensored_link_channels
+            guild_id
         )
-    }
+        self.stats["submitted"] += 1
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+
+    def forget(self, channel_ids):
+        """Deletes every setting of the given channels, in memory right away.
+        Returns the ids of the channels that had any."""
+
+        removed = {
+            channel_id for channel_id in channel_ids
+            if channel_settings.remove(channel_id)
+        }
+        if removed:
+            for key in [key for key in self.pending if key[0] in removed]:
+                del self.pending[key]
+            self.removed |= removed
+            self.stats["forgotten"] += len(removed)
+        return removed
+
+    async def run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            self.full.clear()
+            if self.pending or self.removed:
+                await self.flush()
+
+    async def flush(self):
+        """Writes everything that's waiting, max_batch changes at a time."""
+
+        removed, self.removed = self.removed, set()
+        while self.pending or removed:
+            batch = list(itertools.islice(self.pending, self.max_batch))
+            with store.transaction():
+                store.remove_channels(removed)
+                for key in batch:
+                    store.apply(*self.pending.pop(key))
+            removed = ()
+            self.stats["batches"] += 1
+            self.stats["written"] += len(batch)
+
+    def flush_now(self):
+        """Writes everything that's waiting at once, for when the bot is
+        closing."""
+
+        with store.transaction():
+            store.remove_channels(self.removed)
+            for operation in self.pending.values():
+                store.apply(*operation)
+        self.pending.clear()
+        self.removed.clear()
+
+
+settings_writer = SettingsWriter()
+
+
+@tasks.loop(seconds=CHANNEL_RECONCILE_INTERVAL)
+async def reconcile_channels():
+    """Forgets the settings of channels the bot can't see anymore.
+
+    Deleted channels and guilds the bot leaves are forgotten as the events
+    come in, this catches the ones missed while the bot was offline. DM
+    channels aren't all cached, and the channels of unavailable guilds
+    aren't known, so their settings are left alone. It looks at
+    CHANNEL_RECONCILE_CHUNK channels at a time, letting other tasks run in
+    between."""
+
+    configured = list(channel_settings.records.items())
+    stale = []
+    for i in range(0, len(configured), CHANNEL_RECONCILE_CHUNK):
+        for channel_id, record in configured[i:i+CHANNEL_RECONCILE_CHUNK]:
+            if record.guild_id is None:
+                continue
+            guild = bot.get_guild(record.guild_id)
+            if guild is None or (
+                not guild.unavailable
+                and guild.get_channel_or_thread(channel_id) is None
+            ):
+                stale.append(channel_id)
+        await asyncio.sleep(0)
+    settings_writer.forget(stale)
 
-    if operation == "SET_SHIRT_RANDOM":
-        opdict[operation][3][channel_id] = tuple(opdict[operation][:2])
-    elif operation.startswith("SET_"):
-        opdict[operation][2][channel_id] = opdict[operation][0]
-    elif operation.startswith("UNSET_"):
-        del opdict[operation][1][channel_id]
-    elif operation.startswith("UNCENSOR_"):
-        opdict[operation][1].append(channel_id)
-    elif operation.startswith("CENSOR_"):
-        opdict[operation][1].remove(channel_id)
-    file, lst = opdict[operation][-2:]
-
-    bak = open(f"data/{file}_backup.txt", "w")
-    f = open(f"data/{file}.txt", "r+")
-    bak.write(f.read())
-    bak.close()
-    f.seek(0)
-    if file == "uncensored_links":
-        to_write = '\n'.join(map(str, lst))
-    elif file == "shirt_random":
-        to_write = '\n'.join([
-            f"{k} {' '.join(map(str, v))}" for k, v in lst.items()
-        ])
-    else:
-        to_write = '\n'.join(f"{k} {v}" for k, v in lst.items())
-    f.write(to_write)
-    f.truncate()
-    f.close()
 
-    bot.queue.task_done()
+@reconcile_channels.before_loop
+async def before_reconcile_channels():
+    await bot.wait_until_ready()
 
 
-async def clean_unused_channels():
+def guild_channel_settings(guild):
+    """Returns the guild's channels with settings and their records, in the
+    order the guild lists them."""
+
+    channels = []
+    for channel_id, record in channel_settings.in_guild(guild.id):
+        channel = guild.get_channel(channel_id)
+        if channel is not None:
+            channels.append((channel, record))
+    channels.sort(key=lambda item: (item[0].position, item[0].id))
+    return channels
+
+
+def assign_guilds():
+    """Fills in the guilds of channels stored before guilds were, once the
+    bot can see them."""
+
+    assigned = []
+    unassigned = [
+        channel_id for channel_id, record in channel_settings.records.items()
+        if record.guild_id is None
+    ]
+    for channel_id in unassigned:
+        guild = getattr(bot.get_channel(channel_id), "guild", None)
+        if guild is not None:
+            channel_settings.set_guild(channel_id, guild.id)
+            assigned.append((channel_id, guild.id))
+    if assigned:
+        with store.transaction():
+            store.set_guilds(assigned)
+
+
+# #########################
+# ### Exporting Metrics ###
+# #########################
+
+
+def render_metrics():
+    """Returns the bot's metrics in Prometheus' text format."""
+
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f"# HELP shirt_{name} {help}")
+        lines.append(f"# TYPE shirt_{name} {kind}")
+        for labels, value in samples:
+            labels = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(
+                f"shirt_{name}{{{labels}}} {value}" if labels
+                else f"shirt_{name} {value}"
+            )
 
-    await bot.wait_until_ready()
+    def histogram(name, help, histogram):
+        samples = [
+            ({"le": bucket}, count)
+            for bucket, count in zip(histogram.buckets, histogram.counts)
+        ]
+        samples.append(({"le": "+Inf"}, histogram.count))
+        lines.append(f"# HELP shirt_{name} {help}")
+        lines.append(f"# TYPE shirt_{name} histogram")
+        for labels, value in samples:
+            lines.append(f'shirt_{name}_bucket{{le="{labels["le"]}"}} {value}')
+        lines.append(f"shirt_{name}_sum {histogram.sum}")
+        lines.append(f"shirt_{name}_count {histogram.count}")
+
+    metric(
+        "messages_seen_total", "counter",
+        "Messages the router has seen.",
+        [({}, sum(route_stats.values()))]
+    )
+    metric(
+        "messages_routed_total", "counter",
+        "Messages by the mode that handled them.",
+        [
+            ({"mode": route.value}, route_stats[route]) for route in Route
+            if route != Route.IGNORE
+        ]
+    )
+    metric(
+        "messages_ignored_total", "counter",
+        "Ignored messages by why they were ignored.",
+        [({"reason": reason}, count) for reason, count in ignore_stats.items()]
+    )
+    histogram(
+        "history_fetch_seconds",
+        "Time taken to collect a channel's messages for a prompt.",
+        history_fetch_seconds
+    )
+    metric(
+        "tokenizer_calls_total", "counter",
+        "Tokenizer calls by where they ran.",
+        [({"where": k}, v) for k, v in tokenizer.calls.items()]
+    )
+    metric(
+        "tokenizer_seconds_total", "counter",
+        "Time spent tokenizing by where it ran.",
+        [({"where": k}, v) for k, v in tokenizer.seconds.items()]
+    )
+    histogram(
+        "completion_seconds",
+        "Time from queueing a completion request to its response.",
+        completion_seconds
+    )
+    metric(
+        "api_responses_total", "counter",
+        "API responses by status code.",
+        [
+            ({"status": k.split()[1]}, v) for k, v in api_stats.items()
+            if k.startswith("status ")
+        ]
+    )
+    metric(
+        "api_connection_errors_total", "counter",
+        "API requests that failed to connect or timed out.",
+        [({}, api_stats["connection errors"])]
+    )
+    metric(
+        "api_retries_total", "counter",
+        "Retried API requests.",
+        [({}, api_stats["retries"])]
+    )
+    metric(
+        "filter_hits_total", "counter",
+        "Sent messages the filters changed, by filter.",
+        [({"filter": k}, v) for k, v in filter_hits.items()]
+    )
+    metric(
+        "data_queue_depth", "gauge",
+        "Channel settings changes waiting to be written.",
+        [({}, len(settings_writer.pending))]
+    )
+    metric(
+        "data_changes_total", "counter",
+        "Channel settings changes, by whether they were written or replaced "
+        "by a later change before that.",
+        [
+            ({"result": "written"}, settings_writer.stats["written"]),
+            ({"result": "folded"}, settings_writer.stats["folded"]),
+        ]
+    )
+    metric(
+        "data_forgotten_channels_total", "counter",
+        "Channels whose settings were deleted because they're gone.",
+        [({}, settings_writer.stats["forgotten"])]
+    )
+    metric(
+        "data_batches_total", "counter",
+        "Transactions the channel settings changes were written in.",
+        [({}, settings_writer.stats["batches"])]
+    )
+    metric(
+        "completion_queue_depth", "gauge",
+        "Completion requests waiting for the scheduler.",
+        [(
+            {"priority": priority.name.lower()},
+            sum(map(len, completion_scheduler.queues[priority].values()))
+        ) for priority in Priority]
+    )
+    metric(
+        "event_loop_lag_seconds", "gauge",
+        "The event loop's latest lag.",
+        [({}, loop_lag.samples[-1] if loop_lag.samples else 0.0)]
+    )
+    metric(
+        "event_loop_lag_max_seconds", "gauge",
+        "The event loop's largest lag in the recent samples.",
+        [({}, max(loop_lag.samples, default=0.0))]
+    )
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves render_metrics at /metrics, returns the runner to clean up."""
+
+    async def handle(request):
+        return web.Response(
+            body=render_metrics().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
 
-    all_channels = list(bot.private_channels)+list(bot.get_all_channels())
-    all_channels = [c.id for c in all_channels]
-    for channel in list(shirt_talk_channels):
-        if channel not in all_channels:
-            del shirt_talk_channels[channel]
-    for channel in list(shirt_reply_channels):
-        if channel not in all_channels:
-            del shirt_reply_channels[channel]
-    for channel in list(shirt_random_channels):
-        if channel not in all_channels:
-            del shirt_random_channels[channel]
-    for channel in uncensored_link_channels.copy():
-        if channel not in all_channels:
-            uncensored_link_channels.remove(channel)
 
 # ####################
 # ### Some Filters ###